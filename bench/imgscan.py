@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Benchmark of <img> tag scanning in ImageScraper._images.
+
+Compares the old scanner, which flattened the page with replace(),
+then sliced each tag after every attribute and searched the match
+pattern uncompiled, with ImageScraper._images itself, the single pass
+scanner which matches tags and attributes in place by offset with a
+pre-compiled pattern. The old scanner is kept here as the baseline.
+
+Pages recorded from Lemon and SLS can be given on the command line as
+FILE:PATTERN pairs, e.g. "lemon.html:/lemon-web/images/". Without
+arguments synthetic pages resembling Lemon cluster status pages and SLS
+history pages are generated: many small tags, a few of them matching,
+with attributes spread over several lines, plus a page of few tags
+each with hundreds of attributes.
+
+Checks both scanners find the same images, and reports milliseconds
+per page scan for each.
+
+Needs the Overview package and its dependencies on the python path.
+
+Usage: python bench/imgscan.py [ROUNDS] [FILE:PATTERN...]"""
+import os, sys, re, time, random, urlparse
+from threading import Condition
+os.environ.setdefault("OVERVIEW_VERSION", "bench")
+from Overview.Scraper import ImageScraper, Task
+
+RX_IMG_OLD = re.compile(r"<img\s+(.*?)/?>", re.I)
+RX_ATTR_OLD = re.compile(r"^([-A-Za-z0-9]+)=(\"[^\"]*\"|'[^']*'|\S+)\s*/?")
+PAGE_URL = "http://localhost/page"
+
+class BenchScraper(ImageScraper):
+  """ImageScraper with only the state `_images()` needs, which does not
+  request the images it finds."""
+  def __init__(self):
+    self._cv = Condition()
+    self._imagepage = {}
+
+  def _fetchimages(self, task, found):
+    pass
+
+def unquote(arg):
+  if len(arg) >= 2 and arg[0] == '"' and arg[-1] == '"':
+    return arg[1:-1]
+  elif len(arg) >= 2 and arg[0] == "'" and arg[-1] == "'":
+    return arg[1:-1]
+  return arg
+
+def scan_old(page, match):
+  found = []
+  for imgtag in re.findall(RX_IMG_OLD, page.replace("\n", " ")):
+    while True:
+      m = RX_ATTR_OLD.match(imgtag)
+      if not m:
+        break
+      arg = unquote(m.group(2))
+      if m.group(1) == "src" and re.search(match, arg):
+        found.append(arg.replace("&amp;", "&").replace(" ", "%20"))
+      imgtag = imgtag[m.end():]
+  return found
+
+def scan_new(scraper, task, page, match, images):
+  return [url for key, url in scraper._images(task, page, match, images)]
+
+def synthetic(kind, ntags):
+  if kind == "attrs":
+    return "<html>" + "".join('<IMG %s src="/lemon-web/images/g%d.png"/>\n' %
+      (" ".join('data-a%d="%s"' % (j, "v" * 20) for j in xrange(300)), i)
+      for i in xrange(ntags)) + "</html>"
+
+  rnd = random.Random(ntags)
+  parts = ["<html><head><title>%s</title></head><body>\n" % kind]
+  for i in xrange(ntags):
+    parts.append("<tr><td class='c%d'>%s</td><td>%.2f</td>\n"
+                 % (i % 7, "x" * rnd.randint(10, 200), rnd.random()))
+    if i % 50 == 0:
+      src = (kind == "lemon" and "/lemon-web/images/graph_%d.png?t=%d&amp;h=1" % (i, i)) \
+            or "graph.php?id=EOSCMS&amp;more=nv_mult&amp;n=%d" % i
+    else:
+      src = "/icons/status_%d.gif" % (i % 5)
+    parts.append('<img alt="status %d"\n  width=16 height=16\n  src="%s"\n'
+                 '  title=\'item %d\' border=0 />\n' % (i, src, i))
+  parts.append("</body></html>\n")
+  return "".join(parts)
+
+def main():
+  rounds = int((len(sys.argv) > 1 and sys.argv[1]) or 20)
+  pages = []
+  for arg in sys.argv[2:]:
+    path, pattern = arg.split(":", 1)
+    pages.append((path, open(path).read(), pattern))
+  if not pages:
+    for kind, pattern in (("lemon", "/lemon-web/images/"), ("sls", "graph")):
+      for ntags in (500, 5000):
+        pages.append(("%s-%d" % (kind, ntags), synthetic(kind, ntags), pattern))
+    pages.append(("attrs-100", synthetic("attrs", 100), "/lemon-web/images/"))
+
+  scraper = BenchScraper()
+  task = Task(PAGE_URL, ("image", "bench", "page"), 900, "text/html",
+              None, None, None)
+  print "%-14s %9s %7s %10s %10s %8s" % \
+    ("page", "bytes", "found", "old-ms", "new-ms", "speedup")
+  for label, page, pattern in pages:
+    rx = re.compile(pattern)
+    old = [urlparse.urljoin(PAGE_URL, url) for url in scan_old(page, pattern)]
+    images = ["image%d" % i for i in xrange(len(old))]
+    new = scan_new(scraper, task, page, rx, images)
+    assert old == new, (label, old[:3], new[:3])
+
+    start = time.time()
+    for _ in xrange(rounds):
+      scan_old(page, pattern)
+    told = (time.time() - start) * 1000. / rounds
+
+    start = time.time()
+    for _ in xrange(rounds):
+      scan_new(scraper, task, page, rx, images)
+    tnew = (time.time() - start) * 1000. / rounds
+
+    print "%-14s %9d %7d %10.2f %10.2f %7.1fx" % \
+      (label, len(page), len(new), told, tnew, told / max(tnew, 1e-9))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Benchmark of image serving reads from ContentCache while scraping.
+
+Compares reading values under the cache lock, as ContentCache did
+before reads went lock-free, with the lock-free ContentCache.exists()
+and value() image requests use now. Both use the real cache code: the
+locked reads take the cache lock around the same _has() and _get()
+lookups the public methods use.
+
+A number of client threads serve images as ImageScraperEntity does:
+check the image exists, then get its value record, in a loop. At the
+same time a "pump" thread runs a scrape cycle like the server thread:
+it holds the lock while storing new values with _put(), and releases
+it while waiting for curl, in HOLD and WAIT millisecond slices.
+
+Reports image requests per second over all clients, and the median,
+99th percentile and maximum time per request.
+
+Needs the Overview package and its dependencies on the python path.
+
+Usage: python bench/imgserve.py [CLIENTS [SECONDS [HOLD WAIT]]]"""
+import os, sys, time, random
+from threading import Thread, Condition
+os.environ.setdefault("OVERVIEW_VERSION", "bench")
+from Overview.Scraper import ContentCache, TimedLock
+
+SECTIONS = [("image", "lemon", "cluster%d" % i) for i in xrange(40)]
+TITLES = ["graph%d" % i for i in xrange(25)]
+ISIMAGE = lambda v: isinstance(v.data, str) and v.data
+
+class BenchCache(ContentCache):
+  """ContentCache with only the state needed to store and read values:
+  no request manager, certificates or server thread."""
+  def __init__(self):
+    self._lock = TimedLock()
+    self._cv = Condition(self._lock)
+    self._values = {}
+    self._sections = {}
+    self._usage = {}
+    self._nbytes = 0
+    self.stopme = False
+
+  def locked_exists(self, key, predicate=None):
+    with self._cv:
+      return self._has(key, predicate)
+
+  def locked_value(self, key):
+    with self._cv:
+      return self._get(key)[1]
+
+  view_exists = ContentCache.exists
+  view_value = ContentCache.value
+
+def pump(cache, keys, hold, wait):
+  rnd = random.Random(1)
+  with cache._cv:
+    while not cache.stopme:
+      end = time.time() + hold
+      while time.time() < end:
+        cache._put(rnd.choice(keys), time.time() + 900,
+                   "x" * rnd.randint(1000, 5000), None, {})
+      cache._cv.release()
+      try:
+        time.sleep(wait)
+      finally:
+        cache._cv.acquire()
+
+def client(cache, keys, mode, seconds, times):
+  exists = getattr(cache, mode + "_exists")
+  value = getattr(cache, mode + "_value")
+  rnd = random.Random(id(times))
+  end = time.time() + seconds
+  while True:
+    start = time.time()
+    if start >= end:
+      break
+    key = rnd.choice(keys)
+    if exists(key, ISIMAGE):
+      value(key).data
+    times.append(time.time() - start)
+
+def run(mode, nclients, seconds, hold, wait):
+  cache = BenchCache()
+  keys = [s + (t,) for s in SECTIONS for t in TITLES]
+  with cache._cv:
+    for key in keys:
+      cache._put(key, time.time() + 900, "x" * 3000, None, {})
+  p = Thread(target=pump, args=(cache, keys, hold, wait))
+  p.start()
+  times = [[] for _ in xrange(nclients)]
+  clients = [Thread(target=client, args=(cache, keys, mode, seconds, t))
+             for t in times]
+  for c in clients:
+    c.start()
+  for c in clients:
+    c.join()
+  with cache._cv:
+    cache.stopme = True
+  p.join()
+  times = sorted(sum(times, []))
+  return (len(times) / seconds, times[len(times) / 2] * 1000,
+          times[len(times) * 99 / 100] * 1000, times[-1] * 1000)
+
+def main():
+  nclients = int((len(sys.argv) > 1 and sys.argv[1]) or 32)
+  seconds = float((len(sys.argv) > 2 and sys.argv[2]) or 5)
+  hold = float((len(sys.argv) > 3 and sys.argv[3]) or 2) / 1000.
+  wait = float((len(sys.argv) > 4 and sys.argv[4]) or 5) / 1000.
+  print "%d clients, %g seconds, pump holds lock %g ms, waits %g ms" % \
+    (nclients, seconds, hold * 1000, wait * 1000)
+  print "%-8s %12s %10s %10s %10s" % ("reads", "req/s", "p50-ms", "p99-ms", "max-ms")
+  for mode in ("locked", "view"):
+    print "%-8s %12.0f %10.3f %10.3f %10.3f" % \
+      ((mode,) + run(mode, nclients, seconds, hold, wait))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Benchmark of reply wakeups in ContentProxy and HostCache.
+
+Compares the old scheme, where replies hash onto a small number of
+shared condition variables woken with notifyAll(), with the dedicated
+condition variable per reply HostCache.lookup() and ContentProxy.fetch()
+use now. The old scheme is kept here as a model for the baseline; the
+new one is measured with the real lookup() and fetch() waiters.
+
+A number of threads each wait for their own reply, and a single "pump"
+thread completes the replies one at a time in random order, as the
+server threads do. Host lookups are completed by calling the reply with
+the address information, as the resolver does, and fetches by storing
+the response and signaling the task, as the request callbacks do.
+
+Reports the number of times waiting threads woke up, how many of those
+were spurious (the thread's own reply was not yet done and it had to
+wait again), and the number of voluntary and involuntary context
+switches in the process.
+
+Needs the Overview package and its dependencies on the python path.
+
+Usage: python bench/wakeups.py [WAITERS [ROUNDS]]"""
+import os, sys, time, random, resource, threading
+from threading import Thread, Condition
+from collections import OrderedDict
+os.environ.setdefault("OVERVIEW_VERSION", "bench")
+import Overview.DataHost, Overview.Scraper
+from Overview.DataHost import HostCache
+from Overview.IPInfo import IPInfo, ASInfo, GeoIPInfo
+from Overview.Scraper import ContentProxy, TimedLock
+
+class Waits:
+  """Count waits on CountingCondition. Every return from wait() is a
+  wakeup; every wait after the first one in the same thread means the
+  previous wakeup was spurious."""
+  def __init__(self):
+    self.ready = Condition()
+    self.waiting = 0
+    self.wakeups = 0
+    self.threads = set()
+
+  def spurious(self):
+    return self.wakeups - len(self.threads)
+
+  def wait_ready(self, n):
+    with self.ready:
+      while self.waiting < n:
+        self.ready.wait()
+
+WAITS = Waits()
+
+class CountingCondition(threading._Condition):
+  """Condition counting its waits in WAITS, used for the reply signals."""
+  def wait(self, timeout=None):
+    with WAITS.ready:
+      WAITS.waiting += 1
+      WAITS.threads.add(threading.current_thread())
+      WAITS.ready.notifyAll()
+    threading._Condition.wait(self, timeout)
+    with WAITS.ready:
+      WAITS.wakeups += 1
+
+class Reply:
+  def __init__(self, signal):
+    self.signal = signal
+    self.done = False
+
+class BenchHostCache(HostCache):
+  """HostCache with only the state lookup() needs: no resolver or
+  server thread. The benchmark completes the requests itself."""
+  def __init__(self):
+    self._cv = Condition()
+    self._stopme = False
+    self._requests = []
+
+class BenchRequests:
+  """Request manager which just keeps the requests put to it."""
+  def __init__(self):
+    self.tasks = []
+
+  def put(self, task, priority):
+    self.tasks.append(task)
+
+class BenchProxy(ContentProxy):
+  """ContentProxy with only the state fetch() needs: no certificates,
+  curl handles or server thread. The benchmark completes the requests
+  itself."""
+  def __init__(self):
+    self._reqman = BenchRequests()
+    self._lock = TimedLock()
+    self._cv = Condition(self._lock)
+    self._stopme = False
+    self._values = {}
+    self._sections = {}
+    self._inflight = {}
+    self._stats = {}
+    self._statitems = {}
+    self._usage = {}
+    self._nbytes = 0
+    self._failures = {}
+    self._breakers = {}
+    self._maxbytes = 0
+    self._lru = OrderedDict()
+    self._pinned = {}
+    self._expiry = []
+    self._retain = 0
+
+def model(nwaiters):
+  """The old scheme: replies share eight conditions."""
+  signals = [CountingCondition() for _ in xrange(8)]
+  replies = [Reply(signals[i % 8]) for i in xrange(nwaiters)]
+
+  def wait(reply):
+    with reply.signal:
+      while not reply.done:
+        reply.signal.wait()
+
+  def complete():
+    random.shuffle(replies)
+    for r in replies:
+      with r.signal:
+        r.done = True
+        r.signal.notifyAll()
+
+  return [(wait, (r,)) for r in replies], complete
+
+def hostcache(nwaiters):
+  """HostCache.lookup() of one address per waiter."""
+  host = BenchHostCache()
+  addrs = ["10.0.%d.%d" % (i / 256, i % 256) for i in xrange(nwaiters)]
+  infos = {}
+  for addr in addrs:
+    info = infos[addr] = IPInfo(addr)
+    info.asn = ASInfo()
+    info.geoip = GeoIPInfo()
+
+  def complete():
+    with host._cv:
+      requests = host._requests[:]
+    random.shuffle(requests)
+    for r in requests:
+      r.reply(infos[r.hosts[0]], None, 0)
+
+  return [(host.lookup, ("ip", [addr])) for addr in addrs], complete
+
+def proxy(nwaiters):
+  """ContentProxy.fetch() of one URL per waiter."""
+  cache = BenchProxy()
+  sections = [("bench", "s%d" % i) for i in xrange(nwaiters)]
+
+  def complete():
+    with cache._cv:
+      tasks = cache._reqman.tasks[:]
+    random.shuffle(tasks)
+    for task in tasks:
+      cache._store(task, '{"result": []}')
+      cache._signal(task)
+
+  return [(cache.fetch, (s, 300, { "data": "http://localhost/%s" % s[1] }))
+          for s in sections], complete
+
+def run(scheme, nwaiters):
+  WAITS.__init__()
+  Overview.DataHost.Condition = CountingCondition
+  Overview.Scraper.Condition = CountingCondition
+  try:
+    waiters, complete = scheme(nwaiters)
+    threads = [Thread(target=f, args=args) for f, args in waiters]
+    for t in threads:
+      t.start()
+    WAITS.wait_ready(nwaiters)
+  finally:
+    Overview.DataHost.Condition = Condition
+    Overview.Scraper.Condition = Condition
+
+  before = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.time()
+  complete()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  after = resource.getrusage(resource.RUSAGE_SELF)
+  return { "wakeups": WAITS.wakeups, "spurious": WAITS.spurious(),
+           "nvcsw": after.ru_nvcsw - before.ru_nvcsw,
+           "nivcsw": after.ru_nivcsw - before.ru_nivcsw,
+           "elapsed": elapsed }
+
+def main():
+  nwaiters = int((len(sys.argv) > 1 and sys.argv[1]) or 64)
+  rounds = int((len(sys.argv) > 2 and sys.argv[2]) or 20)
+  print "%d waiters, %d rounds, totals per round" % (nwaiters, rounds)
+  print "%-12s %10s %10s %10s %10s %10s" % \
+    ("scheme", "wakeups", "spurious", "vol-csw", "invol-csw", "msecs")
+  for label, scheme in (("shared-8", model), ("host-lookup", hostcache),
+                        ("proxy-fetch", proxy)):
+    total = { "wakeups": 0, "spurious": 0, "nvcsw": 0, "nivcsw": 0, "elapsed": 0 }
+    for _ in xrange(rounds):
+      for k, v in run(scheme, nwaiters).iteritems():
+        total[k] += v
+    print "%-12s %10.1f %10.1f %10.1f %10.1f %10.2f" % \
+      (label, float(total["wakeups"]) / rounds,
+       float(total["spurious"]) / rounds,
+       float(total["nvcsw"]) / rounds,
+       float(total["nivcsw"]) / rounds,
+       total["elapsed"] * 1000. / rounds)
+
+if __name__ == "__main__":
+  main()
@@ -38,6 +38,19 @@ class Config(Configuration):
     app.lemon = "http://lemonweb.cern.ch/lemon-%s/%s.php"
     app.phedex = "https://cmsweb.cern.ch/phedex"
     app.phedexinst = ["prod", "debug", "test"]
+    app.phedexmaxstale = 0
+    app.proxybytes = 256*1024*1024
+    app.maxbodybytes = 128*1024*1024
+    app.hostconnections = None
+    app.hostlimits = { "lemonweb.cern.ch": 2, "sls.cern.ch": 2 }
+    app.hostintervals = { "lemonweb.cern.ch": 0.1 }
+    app.curlevents = False
+    app.preconnect = ["https://cmsweb.cern.ch/"]
+    app.convertthreads = 2
+    app.convertqueue = 100
+    app.imageidle = 0
+    app.imageidleperiod = 6*3600
+    app.scrapemaxperiod = 4*3600
     app.sitedb = "https://cmsweb.cern.ch/sitedb"
     app.world = os.environ["NATURALEARTHDATA_ROOT"] + "/data"
     app.cafdata = ["alca:alca",
@@ -3,6 +3,7 @@ from WMCore.REST.Server import RESTApi
 from WMCore.REST.Format import RawFormat
 from Overview.DataC2CMS import C2CMSImage
 from Overview.DataCAF import CAFData
+from Overview.DataCache import CacheStats
 from Overview.DataDDT import DDTImage
 from Overview.DataEOS import EOSImage
 from Overview.DataHost import HostData
@@ -26,13 +27,14 @@ class Data(RESTApi):
     if not getattr(app, 'contentproxy', None):
       app.contentproxy = ContentProxy(app.appconfig)
     if not getattr(app, 'contentscraper', None):
-      app.contentscraper = ContentScraper(app.appconfig)
+      app.contentscraper = ContentScraper(app.appconfig, app.statedir)
     self.proxy = app.contentproxy
     self.scraper = app.contentscraper
 
     self._add({ "caf":        CAFData(app, self, config, mount),
                 "phedex":     PhEDEx(app, self, config, mount),
                 "host":       HostData(app, self, config, mount),
+                "cache":      CacheStats(app, self, config, mount),
                 "world-map":  WorldMapShape(app, self, config, mount) })
 
 class Image(RESTApi):
@@ -51,7 +53,9 @@ class Image(RESTApi):
     if not getattr(app, 'contentproxy', None):
       app.contentproxy = ContentProxy(app.appconfig)
     if not getattr(app, 'imagescraper', None):
-      app.imagescraper = ImageScraper(app.appconfig)
+      app.imagescraper = ImageScraper(app.appconfig, app.statedir,
+                                      getattr(app.appconfig, "imageidle", 0),
+                                      getattr(app.appconfig, "imageidleperiod", None))
     self.proxy = app.contentproxy
     self.scraper = app.imagescraper
 
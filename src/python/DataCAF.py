@@ -1,5 +1,6 @@
 from WMCore.REST.Server import RESTEntity, restcall
 from WMCore.REST.Tools import tools
+from Overview.Scraper import heavy
 import cjson, re
 
 class CAFData(RESTEntity):
@@ -25,6 +26,7 @@ class CAFData(RESTEntity):
         { "total": float(mt.group(1).replace(",", "")) * 0.95 * 1000**4 / 1024**4,
           "free":  float(mf.group(1).replace(",", "")) * 0.95 * 1000**4 / 1024**4 }
 
+    @heavy
     def _blocks(task, c, page):
       # Parse PhEDEx json data. Find datasets from blocknames, and
       # accumulate statistics on total size and creation time.
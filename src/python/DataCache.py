@@ -0,0 +1,40 @@
+from WMCore.REST.Auth import authz_match
+from WMCore.REST.Server import RESTEntity, restcall
+from WMCore.REST.Error import MissingObject, InvalidParameter
+import cherrypy
+
+class CacheStats(RESTEntity):
+  """REST entity object for content cache statistics."""
+  _caches = { "proxy": "contentproxy",
+              "scraper": "contentscraper",
+              "images": "imagescraper" }
+
+  def validate(self, apiobj, method, api, param, safe):
+    authz_match(role=["Global Admin"], group=["global"])
+    if not len(param.args) or param.args[0] not in self._caches:
+      raise InvalidParameter("Missing or wrong cache name")
+    safe.kwargs["cache"] = param.args.pop(0)
+
+  def _cache(self, name):
+    cache = getattr(self.app, self._caches[name], None)
+    if not cache:
+      raise MissingObject("No such cache")
+    return cache
+
+  def _statistics(self, cache):
+    stats = cache.statistics()
+    cherrypy.request.rest_generate_preamble = \
+      { "columns": ["value", "statistic", "item"] }
+    return [[stats[key], key[0], key[1]]
+            for key in sorted(stats.keys())]
+
+  @restcall
+  def get(self, cache):
+    return self._statistics(self._cache(cache))
+
+  @restcall
+  def post(self, cache):
+    cache = self._cache(cache)
+    stats = self._statistics(cache)
+    cache.reset_statistics()
+    return stats
@@ -9,7 +9,7 @@ from Overview.Debug import debug
 from threading import Thread, Condition
 from collections import namedtuple
 from netaddr import IPAddress
-import cjson, re, cherrypy, time, random
+import cjson, re, cherrypy, time
 
 RXIP = re.compile(r"^[.0-9]+$")
 RXHOST = re.compile(r"^(?:[-a-z0-9]+\.)+[a-z]{2,5}$")
@@ -129,7 +129,6 @@ class Reply:
 class HostCache(Thread):
   """Utility to resolve host information."""
   _PURGE_INTERVAL = 4*3600
-  _NUM_SIGS = 8
 
   def __init__(self, statedir):
     Thread.__init__(self, name = "HostCache")
@@ -138,7 +137,6 @@ class HostCache(Thread):
     self._stopme = False
     self._requests = []
     self._last_purge = time.time()
-    self._signals = map(lambda x: Condition(), xrange(0, self._NUM_SIGS))
     cherrypy.engine.subscribe('start', self.start)
     cherrypy.engine.subscribe('stop', self.stop, priority=100)
 
@@ -177,7 +175,7 @@ class HostCache(Thread):
     reply = Reply()
     reply.kind = kind
     reply.until = time.time() + maxwait
-    reply.signal = random.choice(self._signals)
+    reply.signal = Condition()
     reply.pending = set(hosts)
 
     with self._cv:
@@ -259,6 +257,12 @@ class HostCache(Thread):
           self._cv.wait((self._requests and 0.25) or None)
           debug("HOSTDATA", 2, "wait done")
 
+      requests = self._requests[:]
+
+    debug("HOSTDATA", 1, "server thread stopped, waking waiters")
+    for r in requests:
+      with r.reply.signal:
+        r.reply.signal.notifyAll()
     debug("HOSTDATA", 1, "server thread stopped")
 
 class HostData(RESTEntity):
@@ -6,11 +6,16 @@ from WMCore.REST.Error import InvalidParameter, NoSuchInstance, \
 
 class DataServiceEntity(RESTEntity):
   # Use supplied 'expires' for response header, but cache data only for 120s.
+  # Entities can opt in to serving data up to '_maxstale' seconds past its
+  # retention while it is refreshed, by default per server configuration.
   _retention = 120
+  _maxstale = None
 
   def __init__(self, app, api, config, mount):
     RESTEntity.__init__(self, app, api, config, mount)
     self._datasvc = app.appconfig.phedex + "/datasvc/json"
+    if self._maxstale is None:
+      self._maxstale = getattr(app.appconfig, "phedexmaxstale", 0)
 
   def validate(self, apiobj, method, api, param, safe):
     pass
@@ -20,9 +25,15 @@ class DataServiceEntity(RESTEntity):
 
   def _retrieve(self, key, urls, convert=None, merge=None, expires=None):
     expires = expires or getattr(self, "_expires", 86400)
+    status = {}
     val = self.api.proxy.fetch(("phedex", "datasvc") + key, self._retention, urls,
-                               convert=convert or self._convert, merge=merge)
+                               convert=convert or self._convert, merge=merge,
+                               maxstale=self._maxstale, status=status)
     cherrypy.response.headers["Cache-Control"] = "max-age=%d" % expires
+    cherrypy.response.headers["X-Cache-Freshness"] = status["state"]
+    if status["state"] == "stale":
+      cherrypy.response.headers["Warning"] = '110 - "Response is Stale"'
+      cherrypy.response.headers["Age"] = "%d" % (self._retention + status["age"])
     return val
 
 class TranslatedDataServiceEntity(DataServiceEntity):
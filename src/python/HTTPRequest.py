@@ -1,5 +1,125 @@
 from cStringIO import StringIO
+from collections import deque, OrderedDict
+from urlparse import urlsplit
 from pycurl import *
+import os, re, zlib, time, errno, fcntl, select
+
+RX_CONTENT_ENCODING = re.compile(r"(?i)^content-encoding:\s*(\S+)")
+RX_CONTENT_LENGTH = re.compile(r"(?i)^content-length:\s*(\d+)")
+
+# Request priority classes, in the order they are served.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = ["interactive", "bulk"]
+
+_share = None
+
+def shared_handle():
+  """Return the process-wide `CurlShare` object. Request managers using
+  it share the DNS cache and SSL sessions. The connection cache is not
+  shared: libcurl does not support using a shared connection cache from
+  several threads, and each manager already reuses its own connections."""
+  global _share
+  if not _share:
+    _share = CurlShare()
+    _share.setopt(SH_SHARE, LOCK_DATA_DNS)
+    _share.setopt(SH_SHARE, LOCK_DATA_SSL_SESSION)
+  return _share
+
+class ResponseSnapshot:
+  """Copy of the response information of a completed request.
+
+  Unlike the curl handle, which is reused for other requests as soon as
+  the response callback returns, this remains valid for processing the
+  response later or in another thread. Provides the response ``headers``
+  and ``getinfo()`` for the HTTP code, content type and effective URL."""
+  _INFO = (HTTP_CODE, CONTENT_TYPE, EFFECTIVE_URL)
+
+  def __init__(self, c):
+    self.headers = list(c.headers)
+    self.info = dict((what, c.getinfo(what)) for what in self._INFO)
+
+  def getinfo(self, what):
+    return self.info[what]
+
+class ResponseBuffer:
+  """Collector of the response headers and body of one request.
+
+  Response header lines are appended to ``headers``, and the body is
+  written into a string buffer. Headers of any earlier responses, for
+  example redirects, are discarded when a new response starts.
+
+  If `decode` is set, "gzip" and "deflate" content encodings are
+  decompressed incrementally as the body arrives, so the compressed
+  body is never held in memory in full. Other content encodings are
+  left as they are; ``encoding`` tells which encoding was used.
+
+  If `maxsize` is set, the transfer is aborted as soon as the response
+  is known to exceed that many bytes, either from the Content-Length
+  header or the amount of data received, before or after decoding.
+  The reason is then left in ``error``."""
+
+  def __init__(self, decode = False, maxsize = None):
+    self.decode = decode
+    self.maxsize = maxsize
+    self.headers = []
+    self.encoding = None
+    self.error = None
+    self._reset()
+
+  def _reset(self):
+    self.encoding = None
+    self._body = StringIO()
+    self._decoder = None
+    self._size = 0
+
+  def _toobig(self, size, what):
+    if self.maxsize and size > self.maxsize:
+      self.error = "%s size %d exceeds limit %d" % (what, size, self.maxsize)
+      return True
+    return False
+
+  def header(self, line):
+    """Curl header callback."""
+    if line.startswith("HTTP/"):
+      del self.headers[:]
+      self._reset()
+
+    self.headers.append(line)
+    m = RX_CONTENT_LENGTH.match(line)
+    if m and self._toobig(int(m.group(1)), "response"):
+      return 0
+
+    m = RX_CONTENT_ENCODING.match(line)
+    if m:
+      self.encoding = m.group(1).lower()
+      if self.decode and self.encoding == "gzip":
+        self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      elif self.decode and self.encoding == "deflate":
+        self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+
+  def write(self, data):
+    """Curl write callback."""
+    if self._decoder and self.maxsize:
+      # Never inflate more than one byte past the limit, however much
+      # the compressed data would expand to.
+      data = self._decoder.decompress(data, self.maxsize - self._size + 1)
+      if self._decoder.unconsumed_tail:
+        self.error = "body size exceeds limit %d" % self.maxsize
+        return 0
+    elif self._decoder:
+      data = self._decoder.decompress(data)
+    self._size += len(data)
+    if self._toobig(self._size, "body"):
+      return 0
+    self._body.write(data)
+
+  def getvalue(self):
+    """Return the response body, decoded if so requested."""
+    if self._decoder:
+      self._body.write(self._decoder.flush())
+      self._decoder = None
+    return self._body.getvalue()
 
 class RequestManager:
   """Manager of multiple concurrent or overlapping HTTP requests.
@@ -14,6 +134,28 @@ class RequestManager:
   responding and handling errors on connections. At the very least
   the request response callback should be defined.
 
+  Requests are queued in priority classes. Whenever a connection is
+  free, the oldest request in the highest priority class is started,
+  so for example interactive requests jump ahead of bulk ones. The
+  time requests spend waiting in the queue is recorded per class.
+
+  The number of simultaneous connections to any one upstream host can
+  be limited, and a minimum interval can be required between starting
+  requests to the same host. Requests to a host at its limit are held
+  back without blocking requests to other hosts; within a priority
+  class, hosts are served round-robin.
+
+  By default requests are driven by polling curl with ``perform()`` and
+  ``select()`` with a one second tick. With `event_driven` set, the
+  manager instead uses curl's socket and timer callbacks with ``epoll``,
+  reacting to socket activity as it happens and otherwise sleeping
+  exactly until curl's next timeout or until new requests are queued.
+
+  Managers can share the DNS cache and SSL sessions via the
+  `shared_handle()` object, and can open connections to known upstream
+  servers before the first real request with `preconnect()`. The number
+  of new connections made is recorded per host.
+
   This class is not designed for multi-threaded use. It employs
   overlapping requests, but in a single thread. Only one thread
   at a time should be calling `process()`; several threads may
@@ -23,7 +165,11 @@ class RequestManager:
   def __init__(self, num_connections = 10, ssl_opts = None,
                user_agent = None, request_headers = None,
                request_init = None, request_respond = None,
-               request_error = None, handle_init = None):
+               request_error = None, handle_init = None,
+               decode_content = False, max_body_size = None,
+               request_host = None, host_connections = None,
+               host_limits = None, host_intervals = None,
+               event_driven = False, share = None):
     """Initialise the request manager. The arguments are:
 
     :arg num_connections: maximum number of simultaneous connections.
@@ -41,17 +187,66 @@ class RequestManager:
                         default one raises a RuntimeException.
     :arg handle_init: callback for customising connection handles at
                       creation time; the callback will be invoked for each connection
-                      object as it's created and queued to the idle connection list."""
+                      object as it's created and queued to the idle connection list.
+    :arg decode_content: if set, decompress gzip and deflate content
+                         encodings as the response body is received.
+    :arg max_body_size: if set, abort requests whose response body is
+                        larger than this; ``request_init`` can change the
+                        limit for a request via ``c.buffer.maxsize``.
+    :arg request_host: callback returning the upstream host of a task;
+                       the default assumes the task is a URL.
+    :arg host_connections: if set, the default maximum number of
+                           simultaneous connections per upstream host.
+    :arg host_limits: optional dictionary of per-host connection limits,
+                      overriding `host_connections` for those hosts.
+    :arg host_intervals: optional dictionary of minimum time in seconds
+                         between starting requests to the same host.
+    :arg event_driven: if set and supported by this platform and pycurl,
+                       drive requests from socket events with ``epoll``.
+    :arg share: optional `CurlShare` object for the connection handles,
+                normally `shared_handle()`.
+
+    The response headers are available in ``c.headers`` and the body
+    in ``c.buffer``, a `ResponseBuffer`, for the callbacks."""
     self.request_respond = request_respond or self._request_respond
     self.request_error = request_error or self._request_error
     self.request_init = request_init or self._request_init
+    self.request_host = request_host or self._request_host
+    self.host_connections = host_connections
+    self.host_limits = host_limits or {}
+    self.host_intervals = host_intervals or {}
+    self.decode_content = decode_content
+    self.max_body_size = max_body_size
     self.cm = CurlMulti()
     self.handles = [Curl() for i in xrange(0, num_connections)]
     self.free = [c for c in self.handles]
-    self.queue = []
+    self.queue = [OrderedDict() for p in PRIORITY_NAMES]
+    self.nqueued = 0
+    self.hostqueued = {}
+    self.hostactive = {}
+    self.hostnext = {}
+    self.wakeup = None
+    self.waits = [[0, 0., 0.] for p in PRIORITY_NAMES]
+    self.connects = {}
+    self.since = time.time()
+    self.epoll = None
+
+    if event_driven and hasattr(select, "epoll") \
+       and "M_SOCKETFUNCTION" in globals():
+      self.epoll = select.epoll()
+      self.sockets = {}
+      self.timeout = None
+      self.pipe = os.pipe()
+      for fd in self.pipe:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+      self.epoll.register(self.pipe[0], select.EPOLLIN)
+      self.cm.setopt(M_SOCKETFUNCTION, self._socket)
+      self.cm.setopt(M_TIMERFUNCTION, self._timer)
 
     for c in self.handles:
       c.buffer = None
+      c.headers = None
+      c.host = None
       c.setopt(NOSIGNAL, 1)
       c.setopt(TIMEOUT, 300)
       c.setopt(CONNECTTIMEOUT, 30)
@@ -67,6 +262,8 @@ class RequestManager:
           c.setopt(SSLKEYPASSWD, ssl_opts.key_pass)
       if request_headers:
         c.setopt(HTTPHEADER, request_headers)
+      if share:
+        c.setopt(SHARE, share)
       if handle_init:
         handle_init(c)
 
@@ -74,6 +271,10 @@ class RequestManager:
     """Default request initialisation callback."""
     c.setopt(URL, url)
 
+  def _request_host(self, url):
+    """Default request host callback."""
+    return urlsplit(url).netloc
+
   def _request_error(self, c, task, errmsg, errno):
     """Default request error callback."""
     raise RuntimeError((task, errmsg, errno))
@@ -82,10 +283,144 @@ class RequestManager:
     """Default request response callback."""
     pass
 
-  def put(self, task):
+  def put(self, task, priority = PRIORITY_BULK):
     """Add a new task. The task object should be a tuple and is
-    passed to ``request_init`` callback passed to the constructor."""
-    self.queue.append(task)
+    passed to ``request_init`` callback passed to the constructor.
+    The `priority` is one of the ``PRIORITY_*`` classes."""
+    host = self.request_host(task)
+    queue = self.queue[priority].get(host, None)
+    if queue is None:
+      queue = self.queue[priority][host] = deque()
+    queue.append((time.time(), task))
+    self.hostqueued[host] = self.hostqueued.get(host, 0) + 1
+    self.nqueued += 1
+    if self.epoll:
+      self._wake()
+
+  def _next(self):
+    """Remove and return the next (host, task) to start, or None if all
+    queued tasks are for hosts at their connection limit or interval.
+    In the latter case sets ``wakeup`` to the earliest time a host's
+    interval has elapsed."""
+    now = time.time()
+    self.wakeup = None
+    for priority, hosts in enumerate(self.queue):
+      for host, queue in hosts.iteritems():
+        limit = self.host_limits.get(host, self.host_connections)
+        if limit and self.hostactive.get(host, 0) >= limit:
+          continue
+        if self.hostnext.get(host, 0) > now:
+          self.wakeup = min(self.wakeup or 1e100, self.hostnext[host])
+          continue
+
+        # Take the oldest task and move the host to the back of the
+        # line so the next request goes to another host if possible.
+        queued, task = queue.popleft()
+        del hosts[host]
+        if queue:
+          hosts[host] = queue
+
+        self.nqueued -= 1
+        self.hostqueued[host] -= 1
+        self.hostactive[host] = self.hostactive.get(host, 0) + 1
+        if host in self.host_intervals:
+          self.hostnext[host] = now + self.host_intervals[host]
+
+        wait = now - queued
+        stats = self.waits[priority]
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+        return host, task
+
+  def statistics(self):
+    """Return queue statistics, a dictionary of values keyed by
+    (statistic, priority class or host) tuples."""
+    stats = {}
+    for name, hosts, (n, total, longest) in \
+        zip(PRIORITY_NAMES, self.queue, self.waits):
+      stats[("queue-length", name)] = sum(len(q) for q in hosts.itervalues())
+      stats[("queue-started", name)] = n
+      stats[("queue-wait-avg", name)] = (n and total / n) or 0.
+      stats[("queue-wait-max", name)] = longest
+    for host, n in self.hostqueued.iteritems():
+      stats[("host-queued", host)] = n
+    for host, n in self.hostactive.iteritems():
+      stats[("host-active", host)] = n
+    minutes = max(time.time() - self.since, 1.) / 60
+    for host, (nreq, nconn) in self.connects.iteritems():
+      stats[("host-requests", host)] = nreq
+      stats[("host-connects", host)] = nconn
+      stats[("host-connects-per-minute", host)] = nconn / minutes
+    return stats
+
+  def reset_statistics(self):
+    self.waits = [[0, 0., 0.] for p in PRIORITY_NAMES]
+    self.connects = {}
+    self.since = time.time()
+
+  def preconnect(self, urls, lock = None, unlock = None):
+    """Open connections to the servers of `urls` ahead of real requests.
+
+    Issues a ``HEAD`` request to each URL, up to the number of idle
+    connection handles, to resolve the host name, complete the SSL
+    handshake and leave the connection in the connection cache. The
+    responses are discarded. Returns a list of (url, error message)
+    for the requests which failed. The `lock` and `unlock` arguments
+    are as for `process()`."""
+    pending = {}
+    for url in urls[:len(self.free)]:
+      c = self.free.pop()
+      c.host = self._request_host(url)
+      c.setopt(URL, url)
+      c.setopt(NOBODY, 1)
+      c.setopt(WRITEFUNCTION, lambda data: None)
+      c.setopt(HEADERFUNCTION, lambda data: None)
+      self.cm.add_handle(c)
+      pending[c] = url
+
+    failed = []
+    while pending:
+      while True:
+        try:
+          if unlock: unlock()
+          ret, nhandles = self.cm.perform()
+        finally:
+          if lock: lock()
+
+        if ret != E_CALL_MULTI_PERFORM:
+          break
+
+      while True:
+        numq, ok, err = self.cm.info_read()
+        for c, errnum, errmsg in err:
+          failed.append((pending[c], errmsg))
+        for c in ok + [e[0] for e in err]:
+          self.cm.remove_handle(c)
+          self._connected(c)
+          c.setopt(HTTPGET, 1)
+          c.host = None
+          del pending[c]
+          self.free.append(c)
+        if numq == 0:
+          break
+
+      if pending:
+        try:
+          if unlock: unlock()
+          self.cm.select(1.)
+        finally:
+          if lock: lock()
+
+    return failed
+
+  def _connected(self, c):
+    """Record the number of new connections made for a request."""
+    stats = self.connects.get(c.host, None)
+    if not stats:
+      stats = self.connects[c.host] = [0, 0]
+    stats[0] += 1
+    stats[1] += c.getinfo(NUM_CONNECTS)
 
   def process(self, lock = None, unlock = None):
     """Process pending requests until none are left.
@@ -96,17 +431,26 @@ class RequestManager:
     all failed ones.
 
     Any new requests added by callbacks by invoking ``put()`` are also
-    processed before returning."""
+    processed before returning.
+
+    The `lock` and `unlock` callbacks, if given, are used to release
+    the caller's lock while waiting for network activity."""
+    if self.epoll:
+      return self._process_events(lock, unlock)
+
     npending = 0
-    while self.queue or npending:
-      while self.queue and self.free:
-        c = self.free.pop()
-        c.task = self.queue.pop(0)
-        c.buffer = b = StringIO()
-        c.setopt(WRITEFUNCTION, b.write)
-        self.request_init(c, c.task)
-        self.cm.add_handle(c)
-        npending += 1
+    while self.nqueued or npending:
+      npending += self._start()
+
+      # If everything queued is waiting for a host interval to elapse
+      # and there is nothing in flight, just sleep until it has.
+      if not npending:
+        try:
+          if unlock: unlock()
+          time.sleep(max(0, (self.wakeup or 0) - time.time()))
+        finally:
+          if lock: lock()
+        continue
 
       while True:
         try:
@@ -118,36 +462,174 @@ class RequestManager:
         if ret != E_CALL_MULTI_PERFORM:
           break
 
-      while True:
-        numq, ok, err = self.cm.info_read()
+      npending -= self._finish()
+
+      timeout = 1.
+      if self.wakeup:
+        timeout = min(timeout, max(0, self.wakeup - time.time()))
+      try:
+        if unlock: unlock()
+        self.cm.select(timeout)
+      finally:
+        if lock: lock()
+
+  def _process_events(self, lock, unlock):
+    """Event driven version of `process()`."""
+    npending = 0
+    while self.nqueued or npending:
+      npending += self._start()
 
-        for c in ok:
-          assert npending > 0
-          try:
-            self.cm.remove_handle(c)
-            self.request_respond(c)
-          finally:
-            self.free.append(c)
-            c.buffer = None
-            c.task = None
-            npending -= 1
-
-        for c, errno, errmsg in err:
-          assert npending > 0
-          try:
-            self.cm.remove_handle(c)
-            self.request_error(c, c.task, errmsg, errno)
-          finally:
-            self.free.append(c)
-            c.buffer = None
-            c.task = None
-            npending -= 1
+      # Sleep until the earliest of curl's timeout and the next host
+      # interval, the latter only if there is a free handle to start a
+      # request on. With nothing in flight there are no sockets to watch,
+      # so bound the wait; otherwise new requests queued with `put()`
+      # wake us up via the pipe.
+      wakeup = (self.free and self.wakeup) or 1e100
+      deadline = min(self.timeout or 1e100, wakeup)
+      timeout = -1
+      if deadline < 1e100:
+        timeout = max(0, deadline - time.time())
+      elif not npending:
+        timeout = 1.
 
-        if numq == 0:
-          break
+      try:
+        if unlock: unlock()
+        events = self.epoll.poll(timeout)
+      finally:
+        if lock: lock()
+
+      actions = []
+      for fd, mask in events:
+        if fd == self.pipe[0]:
+          self._drain()
+          continue
+
+        action = 0
+        if mask & select.EPOLLIN: action |= CSELECT_IN
+        if mask & select.EPOLLOUT: action |= CSELECT_OUT
+        if mask & (select.EPOLLERR | select.EPOLLHUP): action |= CSELECT_ERR
+        actions.append((fd, action))
+
+      if self.timeout and self.timeout <= time.time():
+        self.timeout = None
+        actions.append((SOCKET_TIMEOUT, 0))
 
+      # Run all the socket actions in one go without the lock. They only
+      # move data and update the socket and timer state via callbacks.
       try:
         if unlock: unlock()
-        self.cm.select(1.)
+        for fd, action in actions:
+          while True:
+            ret, nhandles = self.cm.socket_action(fd, action)
+            if ret != E_CALL_MULTI_PERFORM:
+              break
       finally:
         if lock: lock()
+
+      npending -= self._finish()
+
+  def _start(self):
+    """Start as many queued requests as there are free handles and
+    hosts not at their limits. Returns the number of requests started.
+
+    Leaves ``wakeup`` set only if the last `_next()` found nothing to
+    start because of host intervals. If all the handles are busy, the
+    pump waits for one to finish rather than for a host interval."""
+    self.wakeup = None
+    nstarted = 0
+    while self.nqueued and self.free:
+      next = self._next()
+      if not next:
+        break
+      self.wakeup = None
+      c = self.free.pop()
+      c.host, c.task = next
+      c.buffer = b = ResponseBuffer(self.decode_content, self.max_body_size)
+      c.headers = b.headers
+      c.setopt(WRITEFUNCTION, b.write)
+      c.setopt(HEADERFUNCTION, b.header)
+      self.request_init(c, c.task)
+      self.cm.add_handle(c)
+      nstarted += 1
+    return nstarted
+
+  def _finish(self):
+    """Dispatch completed requests to the response and error callbacks
+    and release their handles. Returns the number of requests done."""
+    ndone = 0
+    while True:
+      numq, ok, err = self.cm.info_read()
+
+      for c in ok:
+        try:
+          self.cm.remove_handle(c)
+          self.request_respond(c)
+        finally:
+          self._release(c)
+          ndone += 1
+
+      for c, errnum, errmsg in err:
+        try:
+          self.cm.remove_handle(c)
+          self.request_error(c, c.task, errmsg, errnum)
+        finally:
+          self._release(c)
+          ndone += 1
+
+      if numq == 0:
+        break
+    return ndone
+
+  def _socket(self, what, fd, multi, data):
+    """Curl socket callback: track the sockets curl wants watched."""
+    if what == POLL_REMOVE:
+      if fd in self.sockets:
+        del self.sockets[fd]
+        try:
+          self.epoll.unregister(fd)
+        except (IOError, OSError):
+          pass
+      return
+
+    mask = 0
+    if what & POLL_IN: mask |= select.EPOLLIN
+    if what & POLL_OUT: mask |= select.EPOLLOUT
+    if fd in self.sockets:
+      self.epoll.modify(fd, mask)
+    else:
+      self.epoll.register(fd, mask)
+    self.sockets[fd] = mask
+
+  def _timer(self, msecs):
+    """Curl timer callback: remember when curl next wants to be called."""
+    if msecs < 0:
+      self.timeout = None
+    else:
+      self.timeout = time.time() + msecs / 1000.
+
+  def _wake(self):
+    """Wake up `process()` waiting for socket events."""
+    try:
+      os.write(self.pipe[1], "x")
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def _drain(self):
+    """Consume pending wake ups."""
+    try:
+      while os.read(self.pipe[0], 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def _release(self, c):
+    """Return a handle whose request has completed to the free list."""
+    self.hostactive[c.host] -= 1
+    self._connected(c)
+    self.free.append(c)
+    c.buffer = None
+    c.headers = None
+    c.task = None
+    c.host = None
@@ -1,20 +1,144 @@
-import os, sys, re, time, pycurl, urllib, urlparse, cherrypy, traceback, gzip, zlib
+import os, sys, re, time, pycurl, urllib, urlparse, cherrypy, traceback
+import heapq, random, cPickle, itertools, hashlib
 from WMCore.REST.Tools import tools
 from WMCore.REST.Error import MissingObject, InvalidParameter
 from WMCore.REST.Server import RESTEntity, restcall
-from Overview.HTTPRequest import RequestManager
+from Overview.HTTPRequest import RequestManager, PRIORITY_INTERACTIVE, PRIORITY_BULK, \
+     ResponseSnapshot, shared_handle
 from Overview.X509 import SSLOptions
 from Overview.Debug import debug
-from threading import Thread, Condition
-from collections import namedtuple
+from threading import Thread, Condition, RLock
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
+from Queue import Queue, Full
 from cStringIO import StringIO
+from tempfile import mkstemp
+from email.utils import formatdate
 from PIL import Image as PILImage
 
-RX_CONTENT_ENCODING = re.compile(r"(?i)^content-encoding:\s*(\S+)")
+RX_ETAG = re.compile(r"(?i)^etag:\s*(.*?)\s*$")
+RX_LAST_MODIFIED = re.compile(r"(?i)^last-modified:\s*(.*?)\s*$")
 RX_PATH = re.compile(r"^[-a-z0-9]+$")
 
-Value = namedtuple("Value", ["expires", "data"])
-Task = namedtuple("Task", ["url", "key", "period", "content_type", "convert", "result"])
+class Value(object):
+  """Cache entry: expiry time, data, size in bytes and metadata of a
+  value. Entries are never modified once stored, only replaced."""
+  __slots__ = ("expires", "data", "size", "meta")
+
+  def __init__(self, expires, data, size, meta):
+    self.expires = expires
+    self.data = data
+    self.size = size
+    self.meta = meta
+
+  def __repr__(self):
+    return "Value(expires=%r, data=%r, size=%r, meta=%r)" % \
+      (self.expires, self.data, self.size, self.meta)
+
+Task = namedtuple("Task", ["url", "key", "period", "content_type", "convert",
+                           "result", "maxbytes"])
+
+def heavy(convert):
+  """Mark `convert` as an expensive conversion to run in the conversion
+  worker pool rather than on the cache thread. Such conversions run
+  without the cache lock held, and may only use their arguments."""
+  convert.heavy = True
+  return convert
+
+class ConvertPool:
+  """Bounded pool of worker threads for running expensive conversions.
+  The threads are started on first use."""
+  def __init__(self, name, nthreads, maxqueue):
+    self._name = name
+    self._nthreads = nthreads
+    self._queue = Queue(maxqueue)
+    self._threads = []
+    self.maxdepth = 0
+
+  def submit(self, job):
+    """Queue callable `job` to be run by a worker. Returns False without
+    queuing it if the queue is full."""
+    if not self._threads:
+      for i in xrange(self._nthreads):
+        t = Thread(target = self._run, name = "%s-%d" % (self._name, i))
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+    try:
+      self._queue.put_nowait(job)
+    except Full:
+      return False
+    self.maxdepth = max(self.maxdepth, self._queue.qsize())
+    return True
+
+  def depth(self):
+    return self._queue.qsize()
+
+  def stop(self):
+    for t in self._threads:
+      self._queue.put(None)
+
+  def _run(self):
+    while True:
+      job = self._queue.get()
+      if job is None:
+        break
+      job()
+
+class TimedLock:
+  """Reentrant lock which records how long threads wait for it and how
+  long it is held. Supports the internal protocol `Condition` uses to
+  release and restore the lock while waiting, so waits do not count
+  as holding the lock."""
+  def __init__(self):
+    self._lock = RLock()
+    self._depth = 0
+    self._since = 0
+    self.reset()
+
+  def reset(self):
+    self.held = [0, 0., 0.]
+    self.waited = [0, 0., 0.]
+
+  def acquire(self, blocking = 1):
+    start = time.time()
+    if not self._lock.acquire(blocking):
+      return False
+    self._depth += 1
+    if self._depth == 1:
+      self._since = time.time()
+      self._record(self.waited, self._since - start)
+    return True
+
+  def release(self):
+    if self._depth == 1:
+      self._record(self.held, time.time() - self._since)
+    self._depth -= 1
+    self._lock.release()
+
+  __enter__ = acquire
+
+  def __exit__(self, *args):
+    self.release()
+
+  def _record(self, stats, t):
+    stats[0] += 1
+    stats[1] += t
+    stats[2] = max(stats[2], t)
+
+  def _is_owned(self):
+    return self._lock._is_owned()
+
+  def _release_save(self):
+    self._record(self.held, time.time() - self._since)
+    depth, self._depth = self._depth, 0
+    return self._lock._release_save(), depth
+
+  def _acquire_restore(self, state):
+    saved, depth = state
+    self._lock._acquire_restore(saved)
+    self._depth = depth
+    self._since = time.time()
 
 class ContentCache(Thread):
   """Utility to get content from the web"""
@@ -22,6 +146,10 @@ class ContentCache(Thread):
   _ident = "Overview/%s Python/%s" % \
            (os.environ["OVERVIEW_VERSION"],
             ".".join(map(str, sys.version_info[:3])))
+  _BACKOFF_MIN = 30
+  _BACKOFF_MAX = 1800
+  _BREAKER_FAILURES = 5
+  _BREAKER_OPEN = 60
 
   def __init__(self, appconfig):
     debug(self._ID, 1, "creating new content cache")
@@ -35,172 +163,474 @@ class ContentCache(Thread):
                                   user_agent = self._ident,
                                   handle_init = self._hinit,
                                   request_init = self._reqinit,
+                                  request_host = self._reqhost,
                                   request_error = self._reqerror,
-                                  request_respond = self._reqdone)
-    self._cv = Condition()
+                                  request_respond = self._reqdone,
+                                  decode_content = True,
+                                  max_body_size = getattr(appconfig, "maxbodybytes", None),
+                                  host_connections = getattr(appconfig, "hostconnections", None),
+                                  host_limits = getattr(appconfig, "hostlimits", None),
+                                  host_intervals = getattr(appconfig, "hostintervals", None),
+                                  event_driven = getattr(appconfig, "curlevents", False),
+                                  share = shared_handle())
+    self._preconnect = getattr(appconfig, "preconnect", [])
+    self._lock = TimedLock()
+    self._cv = Condition(self._lock)
     self._stopme = False
     self._values = {}
+    self._sections = {}
+    self._inflight = {}
+    self._stats = {}
+    self._statitems = {}
+    self._usage = {}
+    self._nbytes = 0
+    self._failures = {}
+    self._breakers = {}
+    self._converting = {}
+    self._pool = ConvertPool(self._ID.lower() + "-convert",
+                             getattr(appconfig, "convertthreads", 2),
+                             getattr(appconfig, "convertqueue", 100))
     cherrypy.engine.subscribe('start', self.start)
     cherrypy.engine.subscribe('stop', self.stop, priority=100)
 
+  # Values are kept in `_values`, a flat dictionary keyed by the full
+  # key tuple, and indexed by section in `_sections`, a dictionary of
+  # the key prefix to a dictionary of the values in the section by the
+  # last key component. Value records are never modified, only replaced
+  # or removed under the lock, and single dictionary operations are
+  # atomic, so readers use `_values` without the lock, and never wait
+  # for the server thread.
+
   def exists(self, key, predicate=None):
     """Check if the given `key` satisfying `predicate` has been registered."""
-    with self._cv:
-      return self._has(key, predicate)
+    return self._has(key, predicate)
 
   def data(self, key):
     """Returns the data for a previously registered `key`."""
-    with self._cv:
-      _, val = self._get(key)
-      return val.data
+    return self._values[key].data
+
+  def value(self, key):
+    """Returns the value record, with data and metadata, for a
+    previously registered `key`."""
+    return self._values[key]
 
   def stop(self):
     with self._cv:
       self._stopme = True
       self._cv.notifyAll()
+    self._pool.stop()
 
-  def _has(self, key, predicate=None):
+  def statistics(self):
+    """Return a copy of the cache statistics, a dictionary of counters
+    keyed by (statistic, item) tuples."""
+    with self._cv:
+      stats = dict(self._stats)
+      stats.update(self._reqman.statistics())
+      for sect, (nbytes, nentries) in self._usage.iteritems():
+        stats[("bytes", sect)] = nbytes
+        stats[("entries", sect)] = nentries
+      for host, (nfail, until) in self._breakers.iteritems():
+        stats[("host-failures", host)] = nfail
+      stats[("convert-queue-length", "workers")] = self._pool.depth()
+      stats[("convert-queue-max", "workers")] = self._pool.maxdepth
+      for name, (n, total, longest) in (("held", self._lock.held),
+                                        ("wait", self._lock.waited)):
+        stats[("lock-%s-count" % name, "cache")] = n
+        stats[("lock-%s-avg" % name, "cache")] = (n and total / n) or 0.
+        stats[("lock-%s-max" % name, "cache")] = longest
+      return stats
+
+  def reset_statistics(self):
+    with self._cv:
+      self._stats = {}
+      self._statitems = {}
+      self._reqman.reset_statistics()
+      self._pool.maxdepth = 0
+      self._lock.reset()
+
+  @contextmanager
+  def _unlocked(self):
+    """Release the lock, held exactly once by the caller, for the
+    duration of the block."""
+    self._cv.release()
     try:
-      _, val = self._get(key)
-      if predicate:
-        return predicate(val)
-      else:
-        return True
-    except KeyError:
-      return False
+      yield
+    finally:
+      self._cv.acquire()
+
+  def _count(self, stat, key, n=1):
+    if not isinstance(key, basestring):
+      key = "/".join(key)
+    item = (stat, key)
+    if item not in self._stats:
+      self._statitems.setdefault(key, []).append(item)
+      self._stats[item] = 0
+    self._stats[item] += n
+
+  def _uncount(self, key):
+    """Drop the statistics counted for `key`, a key or a section."""
+    if not isinstance(key, basestring):
+      key = "/".join(key)
+    for item in self._statitems.pop(key, ()):
+      del self._stats[item]
+
+  def _blocked(self, key, url, now):
+    """Return the time until which `key` should not be requested from
+    `url` because of earlier failures, or zero if the request can go
+    ahead. Once the circuit breaker of a failing host has been open for
+    a while, a single probe request is let through; the breaker stays
+    open for others until the probe has completed."""
+    until = 0
+    if key in self._failures:
+      until = self._failures[key][1]
+    breaker = self._breakers.get(urlparse.urlsplit(url).netloc, None)
+    if breaker and breaker[0] >= self._BREAKER_FAILURES:
+      if breaker[1] > now:
+        until = max(until, breaker[1])
+      elif until <= now:
+        breaker[1] = now + self._BREAKER_OPEN
+    if until > now:
+      self._count("blocked", key[:-1])
+      return until
+    return 0
+
+  def _retrytime(self, key, now):
+    """Return the time after which a failed `key` should be retried."""
+    failure = self._failures.get(key, None)
+    return max((failure and failure[1]) or 0, now + self._BACKOFF_MIN)
+
+  def _failed(self, task, hostfail):
+    """Record a failed request for `task`. The key is backed off
+    exponentially on each consecutive failure. If `hostfail` is set the
+    failure counts against the host too, and too many consecutive
+    failures open the circuit breaker for the host."""
+    with self._cv:
+      now = time.time()
+      failure = self._failures.setdefault(task.key, [0, 0])
+      failure[0] += 1
+      failure[1] = now + min(self._BACKOFF_MAX,
+                             self._BACKOFF_MIN * 2 ** (failure[0]-1))
+      self._count("failed", task.key[:-1])
+      if hostfail:
+        host = self._reqhost(task)
+        breaker = self._breakers.setdefault(host, [0, 0])
+        breaker[0] += 1
+        if breaker[0] >= self._BREAKER_FAILURES:
+          if breaker[0] == self._BREAKER_FAILURES:
+            cherrypy.log("CACHE WARNING %s failed %d times, suspending requests"
+                         % (host, breaker[0]))
+            self._count("breaker-open", host)
+          breaker[1] = now + self._BREAKER_OPEN
+
+  def _succeeded(self, task):
+    """Clear the failure history of `task` and its host."""
+    with self._cv:
+      self._failures.pop(task.key, None)
+      breaker = self._breakers.pop(self._reqhost(task), None)
+      if breaker and breaker[0] >= self._BREAKER_FAILURES:
+        cherrypy.log("CACHE WARNING %s recovered, resuming requests"
+                     % self._reqhost(task))
 
-  def _get(self, key):
-    if isinstance(key, basestring):
-      return self._values, self._values[key]
-    else:
-      val = self._values
-      for sect in key[:-1]:
-        val = val[sect]
-      leaf = val[key[-1]]
-      if isinstance(leaf, dict):
-        raise KeyError("%s is not a leaf" % key)
-      return val, leaf
-
-  def _put(self, key, expires, value):
-    val = Value(expires, value)
+  def _has(self, key, predicate=None):
+    val = self._values.get(key, None)
+    return val is not None and (not predicate or predicate(val))
+
+  def _split(self, key):
+    """Return the section and name of `key` within it."""
     if isinstance(key, basestring):
-      self._values[key] = val
-      return self._values, val
-    else:
-      v = self._values
-      for sect in key[:-1]:
-        if sect not in v:
-          v[sect] = {}
-        v = v[sect]
-      v[key[-1]] = val
-      return v, val
-
-  def _store(self, task, value):
+      return (), key
+    return key[:-1], key[-1]
+
+  def _get(self, key):
+    """Return the values in the section of `key`, and the value of `key`."""
+    val = self._values[key]
+    return self._sections[self._split(key)[0]], val
+
+  def _put(self, key, expires, value, size=None, meta=None):
+    if size is None:
+      size = (isinstance(value, str) and len(value)) or 0
+    val = Value(expires, value, size, meta)
+    sect, name = self._split(key)
+    container = self._sections.get(sect, None)
+    if container is None:
+      container = self._sections[sect] = {}
+    self._account(key, self._values.get(key, None), val)
+    container[name] = val
+    self._values[key] = val
+    return container, val
+
+  def _account(self, key, old, new):
+    """Update the byte and entry accounting of the top-level section of
+    `key` for replacing value `old` with `new`; either may be None."""
+    sect = (isinstance(key, basestring) and key) or key[0]
+    usage = self._usage.setdefault(sect, [0, 0])
+    if old:
+      usage[0] -= old.size
+      usage[1] -= 1
+      self._nbytes -= old.size
+    if new:
+      usage[0] += new.size
+      usage[1] += 1
+      self._nbytes += new.size
+
+  def _store(self, task, value, size=None, meta=None):
     with self._cv:
-      self._put(task.key, time.time() + task.period, value)
+      self._put(task.key, time.time() + task.period, value, size, meta)
+
+  def _unchanged(self, task, value):
+    """Hook called when the upstream content for `task` is unchanged and
+    its existing stored `value` is reused without conversion."""
+    pass
+
+  def _modified(self, task):
+    """Hook called when a new value for `task` has been stored. May be
+    called without the lock held."""
+    pass
+
+  def _warmup(self):
+    """Connect to the configured upstream servers before first use.
+    Must be called with the lock held."""
+    if self._preconnect:
+      debug(self._ID, 1, "pre-connecting to %d servers", len(self._preconnect))
+      failed = self._reqman.preconnect(self._preconnect,
+                                       lock = self._cv.acquire,
+                                       unlock = self._cv.release)
+      for url, err in failed:
+        cherrypy.log("CACHE WARNING pre-connecting to %s failed: %s" % (url, err))
 
   def _hinit(self, c):
     """Initialise curl handle `c`."""
     c.setopt(pycurl.SSL_VERIFYPEER, 0) # FIXME
     c.setopt(pycurl.SSL_VERIFYHOST, 1)
 
+  def _reqhost(self, task):
+    return urlparse.urlsplit(task.url).netloc
+
   def _reqinit(self, c, task):
     debug(self._ID, 2, "initialising request to %s (%s)",
           task.url, task.content_type)
-    c.headers = []
     c.setopt(pycurl.URL, task.url)
-    c.setopt(pycurl.HEADERFUNCTION, c.headers.append)
-    c.setopt(pycurl.HTTPHEADER, ["Accept: %s" % task.content_type,
-                                 "Accept-Encoding: gzip, deflate"])
+    if task.maxbytes:
+      c.buffer.maxsize = task.maxbytes
+    headers = ["Accept: %s" % task.content_type,
+               "Accept-Encoding: gzip, deflate"]
+
+    # Revalidate the value we already have if upstream gave us validators.
+    if self._has(task.key):
+      _, val = self._get(task.key)
+      if val.data is not None and val.meta:
+        if "etag" in val.meta:
+          headers.append("If-None-Match: %s" % val.meta["etag"])
+        if "modified" in val.meta:
+          headers.append("If-Modified-Since: %s" % val.meta["modified"])
+    c.setopt(pycurl.HTTPHEADER, headers)
+
+  def _validators(self, c):
+    """Return the cache validators in the response headers of `c`, or
+    None if the response had none."""
+    meta = {}
+    for h in c.headers:
+      m = RX_ETAG.match(h)
+      if m:
+        meta["etag"] = m.group(1)
+      m = RX_LAST_MODIFIED.match(h)
+      if m:
+        meta["modified"] = m.group(1)
+    return meta or None
 
   def _reqerror(self, c, task, errmsg, errno):
-    result = getattr(task, "result", None)
+    if c.buffer.error:
+      errmsg = "%s: %s" % (errmsg, c.buffer.error)
     cherrypy.log(("CACHE ERROR %s request failed with error:"
                   " %s (code %d), headers %s") %
                  (getattr(task, "url", c.getinfo(pycurl.EFFECTIVE_URL)),
                   errmsg, errno, c.headers))
-    if result:
+    self._failed(task, not c.buffer.error)
+    self._signal(task, RuntimeError("http error %s (code %d)" % (errmsg, errno)))
+
+  def _signal(self, task, error=None):
+    """Wake up all the replies waiting for `task`, if any. If `error`
+    is set, the replies are failed with it, otherwise the request is
+    marked completed for each of them."""
+    waiters = getattr(task, "result", None)
+    if waiters is None:
+      return
+
+    with self._cv:
+      if self._inflight.get(task.key, None) is waiters:
+        del self._inflight[task.key]
+
+    for result in waiters:
       with result["signal"]:
-        debug(self._ID, 2, "signaling error on %s, pending %d",
-              task.url, result["pending"])
-        if not result["error"]:
-          result["error"] = RuntimeError("http error %s (code %d)"
-                                         % (errmsg, errno))
-        result["signal"].notifyAll()
+        debug(self._ID, 2, "signaling %s on %s, pending %d",
+              (error and "error") or "result", task.url, result["pending"])
+        if error:
+          if not result["error"]:
+            result["error"] = error
+          result["signal"].notifyAll()
+        else:
+          assert result["pending"] > 0
+          result["pending"] -= 1
+          if result["pending"] == 0:
+            result["signal"].notifyAll()
 
   def _reqdone(self, c):
-    result = c.task.result
-
+    code = None
     try:
       code = c.getinfo(pycurl.HTTP_CODE)
       debug(self._ID, 2, "request done %s => http %d", c.task.url, code)
+      old = None
+      if self._has(c.task.key):
+        _, old = self._get(c.task.key)
+        if old.data is None:
+          old = None
+
+      if code == 304 and old:
+        self._count("http-304", c.task.key[:-1])
+        self._keep(c.task, old, self._validators(c))
+        return
+
       if code != 200:
         raise RuntimeError("http response %d from %s" % (code, c.task.url))
 
-      value = c.buffer.getvalue()
-      for h in c.headers:
-        m = RX_CONTENT_ENCODING.match(h)
-        if m:
-          enc = m.group(1)
-          if enc == "deflate":
-            debug(self._ID, 3, "decompressing deflated content")
-            value = zlib.decompress(value, -zlib.MAX_WBITS)
-          elif enc == "gzip":
-            debug(self._ID, 3, "decompressing gzipped content")
-            value = gzip.GzipFile(fileobj=StringIO(value)).read()
-          else:
-            cherrypy.log("WARNING: ignoring content encoding %s for %s"
-                         % (enc, c.task.url))
-
-      if c.task.convert:
+      self._count("http-200", c.task.key[:-1])
+
+      # Post-process the response without holding the lock, so readers
+      # and other requests are not held up. The lock is taken again only
+      # to look at or update the cache.
+      with self._unlocked():
+        value = c.buffer.getvalue()
+        if c.buffer.encoding and c.buffer.encoding not in ("gzip", "deflate"):
+          cherrypy.log("WARNING: ignoring content encoding %s for %s"
+                       % (c.buffer.encoding, c.task.url))
+        task, meta = c.task, self._validators(c) or {}
+        meta["digest"] = hashlib.sha1(value).hexdigest()
+
+      # If the body is exactly what we got last time, keep the value we
+      # already converted from it.
+      if old and old.meta and old.meta.get("digest") == meta["digest"]:
+        self._count("same-content", task.key[:-1])
+        self._keep(task, old, meta)
+        return
+
+      # Hand expensive conversions over to the worker pool, unless it's
+      # already full, in which case just do the conversion here.
+      if getattr(task.convert, "heavy", False):
+        resp = ResponseSnapshot(c)
+        if self._pool.submit(lambda: self._convertjob(task, resp, value, meta)):
+          debug(self._ID, 3, "queued conversion for %s", task.url)
+          self._converting[task.key] = self._converting.get(task.key, 0) + 1
+          return
+        self._count("convert-overflow", task.key[:-1])
+
+      with self._unlocked():
+        self._complete(task, c, value, meta)
+    except Exception, e:
+      self._logerror(c.task, c, e)
+      self._failed(c.task, code is not None and code >= 500)
+      self._signal(c.task, e)
+
+  def _keep(self, task, val, validators):
+    """Extend the expiry of value `val` of `task` whose upstream content
+    is unchanged, updating its metadata with any new `validators`."""
+    debug(self._ID, 1, "extending unchanged value for %s in %s, expires %d",
+          task.url, task.key, task.period)
+    meta = dict(val.meta or {})
+    meta.update(validators or {})
+    self._unchanged(task, val.data)
+    self._store(task, val.data, val.size, meta)
+    self._succeeded(task)
+    self._signal(task)
+
+  def _convertjob(self, task, c, value, meta):
+    """Conversion worker job for `_complete()`."""
+    try:
+      self._complete(task, c, value, meta)
+    finally:
+      with self._cv:
+        self._converting[task.key] -= 1
+        if not self._converting[task.key]:
+          del self._converting[task.key]
+
+  def _complete(self, task, c, value, meta):
+    """Convert and store the response `value` for `task`, then wake up
+    anyone waiting for it. `c` is the curl handle or a snapshot of it.
+    Must be called without the lock held; the conversion runs without
+    it, and the lock is taken only to store the result."""
+    try:
+      size = len(value)
+      start = time.time()
+      if task.convert:
         debug(self._ID, 3, "converting value for %s, len %d",
-              c.task.url, len(value))
-        value = c.task.convert(c.task, c, value)
+              task.url, size)
+        value = task.convert(task, c, value)
 
+      # Remember when the value last changed, and the hash of string
+      # values so they can be served with an ETag.
       if value:
-        debug(self._ID, 1, "storing value for %s into %s, expires %d",
-              c.task.url, c.task.key, c.task.period)
-        self._store(c.task, value)
-
-      if result:
-        with result["signal"]:
-          debug(self._ID, 2, "signaling result on %s, pending %d",
-                c.task.url, result["pending"])
-          assert result["pending"] > 0
-          result["pending"] -= 1
-          if result["pending"] == 0:
-            result["signal"].notifyAll()
+        meta["stored"] = time.time()
+        if isinstance(value, str):
+          meta["hash"] = hashlib.sha1(value).hexdigest()
+
+      with self._cv:
+        if task.convert:
+          self._count("converted", task.key[:-1])
+          self._count("convert-time", task.key[:-1], time.time() - start)
+        if value:
+          debug(self._ID, 1, "storing value for %s into %s, expires %d",
+                task.url, task.key, task.period)
+          self._store(task, value, size, meta)
+          self._modified(task)
+        self._succeeded(task)
+
+      self._signal(task)
     except Exception, e:
-      cherrypy.log(("CACHE ERROR %s processing failed with error:"
-                    " %s, headers %s") % (c.task.url, str(e), c.headers))
-      for line in traceback.format_exc().rstrip().split("\n"):
-        cherrypy.log("  " + line)
-      if result:
-        with result["signal"]:
-          debug(self._ID, 2, "signaling error on %s, pending %d",
-                c.task.url, result["pending"])
-          if not result["error"]:
-            result["error"] = e
-          result["signal"].notifyAll()
+      self._logerror(task, c, e)
+      self._failed(task, False)
+      self._signal(task, e)
+
+  def _logerror(self, task, c, e):
+    cherrypy.log(("CACHE ERROR %s processing failed with error:"
+                  " %s, headers %s") % (task.url, str(e), c.headers))
+    for line in traceback.format_exc().rstrip().split("\n"):
+      cherrypy.log("  " + line)
 
 class ContentProxy(ContentCache):
   """Utility to get content from the web"""
-  _NUM_SIGS = 8
   _ID = "CPROXY"
 
   def __init__(self, appconfig):
     debug(self._ID, 1, "creating new content proxy")
     ContentCache.__init__(self, appconfig)
-    self._signals = map(lambda x: Condition(), xrange(0, self._NUM_SIGS))
+    self._maxbytes = getattr(appconfig, "proxybytes", 0)
+    self._lru = OrderedDict()
+    self._pinned = {}
+    self._expiry = []
+    self._retain = 0
 
   def fetch(self, section, expires, urls,
             content_type="application/json",
-            convert=None, merge=None):
+            convert=None, merge=None,
+            maxstale=0, status=None, maxbytes=None):
     """
     Retrieve data from URLs, caching it locally for `expires` seconds. Usually
     the content is JSON but it can be something else too, like HTML. All the
     URLs will be fetched, converted using `convert`, stored, then merged to a
-    new value with `merge`.
+    new value with `merge`. If the content digests of the inputs are the
+    same as for the last merge, the merged value is reused without merging.
+    Merged values are kept for one more expiry period after they expire so
+    they can still be reused once their inputs have been refetched.
+
+    If `maxstale` is non-zero and the merged value expired less than that
+    many seconds ago, the stale value is returned immediately and the
+    refresh continues in the background. The caller can pass a `status`
+    dictionary to find out if the value was "fresh" or "stale", and its
+    age in seconds since it expired.
+
+    URLs which recently failed, or whose server is failing, are not
+    requested again until their back-off time has passed. The last good
+    value is used for them instead, and the reply is reported as stale;
+    if there is no previous value, the fetch fails immediately.
 
     :arg str section: label for this item
     :arg int expires: maximum time to cache the responses
@@ -208,6 +638,9 @@ class ContentProxy(ContentCache):
     :arg callable convert: response conversion, e.g. cjson.decode
     :arg callable merge: reply post-processor
     :arg dict urls: (title, url) or (title, (url, urledit)) of data to retrieve
+    :arg int maxstale: maximum time to serve expired value while refreshing
+    :arg dict status: if not None, receives "state" and "age" of the reply
+    :arg int maxbytes: maximum response size, if not the server default
     """
     debug(self._ID, 1, "%s: fetch from %s, expires %d, content type %s",
           section, urls, expires, content_type)
@@ -222,87 +655,249 @@ class ContentProxy(ContentCache):
 
     now = time.time()
     merged = section + ("merged",)
-    signal = self._signals[(hash(merged) >> 24) % self._NUM_SIGS]
+    signal = Condition()
     reply = { "pending": 0, "error": None, "signal": signal }
+    nrequests = nrefresh = 0
+    degraded = age = 0
+    if status is None:
+      status = {}
 
     with self._cv:
       if not self._has(merged):
         debug(self._ID, 2, "%s: inserting null value", merged)
         self._put(merged, 0, None)
 
+      # Decide if we can serve an expired merged value while it is being
+      # refreshed. Expired values are retained for the longest staleness
+      # anyone has asked for so they are still around for the next call.
+      _, mval = self._get(merged)
+      stale = (maxstale and mval.data is not None
+               and mval.expires < now <= mval.expires + maxstale)
+      self._retain = max(self._retain, maxstale)
+
       for title, url in urls.iteritems():
         key = section + (title,)
         if self._has(key):
           _, val = self._get(key)
           if val.expires >= now:
             debug(self._ID, 2, "%s: valid value for %s", key, url)
+            self._touch(key)
             continue
         else:
           debug(self._ID, 2, "%s: inserting null value for %s", key, url)
-          self._put(key, 0, None)
+          _, val = self._put(key, 0, None)
+
+        # If someone else already requested this key, attach to their
+        # request and share the result instead of asking again. Don't
+        # make new requests to an upstream which has been failing: use
+        # the last good value, if any, or give up right away.
+        waiters = self._inflight.get(key, None)
+        blocked = waiters is None and \
+                  self._blocked(key, (isinstance(url, tuple) and url[0]) or url, now)
+        if blocked:
+          if val.data is None:
+            # Requests already queued for earlier keys must still go out.
+            if nrequests:
+              self._cv.notifyAll()
+            raise RuntimeError("%s: upstream failing, not retrying for %d seconds"
+                               % (url, blocked - now))
+          debug(self._ID, 1, "%s: using last good value for %s", key, url)
+          self._count("last-good", key)
+          degraded = min(degraded or blocked, blocked)
+          age = max(age, now - val.expires)
+          continue
+        elif waiters is not None:
+          debug(self._ID, 2, "%s: joining pending request", key)
+          self._count("coalesced", key)
+        else:
+          if isinstance(url, tuple):
+            url, urledit = url
+            if urledit:
+              url = urledit(url)
+
+          # Requests someone waits for go ahead of background refreshes.
+          waiters = self._inflight[key] = []
+          self._reqman.put(Task(url, key, expires, content_type, convert,
+                                waiters, maxbytes),
+                           (stale and PRIORITY_BULK) or PRIORITY_INTERACTIVE)
+          self._count("requests", key)
+          nrequests += 1
+          debug(self._ID, 2, "%s: requested %s", key, url)
+
+        nrefresh += 1
+        if not stale:
+          waiters.append(reply)
+          reply["pending"] += 1
+
+      if nrequests:
+        debug(self._ID, 3, "%s: signaling requests", section)
+        self._cv.notifyAll()
 
-        if isinstance(url, tuple):
-          url, urledit = url
-          if urledit:
-            url = urledit(url)
+      if stale and nrefresh:
+        debug(self._ID, 1, "%s: returning stale value while refreshing", merged)
+        self._count("stale", merged)
+        status["state"] = "stale"
+        status["age"] = now - mval.expires
+        return mval.data
 
-        reply["pending"] += 1
-        self._reqman.put(Task(url, key, expires, content_type, convert, reply))
-        debug(self._ID, 2, "%s: requested %s", key, url)
+      # Protect the section from eviction until we have merged it.
+      self._pinned[section] = self._pinned.get(section, 0) + 1
 
-      if reply["pending"]:
-        debug(self._ID, 3, "%s: signaling requests", section)
-        self._cv.notifyAll()
+    try:
+      with signal:
+        while True:
+          if self._stopme:
+            debug(self._ID, 3, "%s: reply cancelled for stop", merged)
+            raise RuntimeError("server stopped")
+          elif reply["error"]:
+            debug(self._ID, 2, "%s: reply was an error", merged)
+            raise reply["error"]
+          elif not reply["pending"]:
+            debug(self._ID, 2, "%s: reply complete", merged)
+            break
+          else:
+            debug(self._ID, 3, "%s: waiting for reply", merged)
+            signal.wait()
 
-    with signal:
-      while True:
-        if self._stopme:
-          debug(self._ID, 3, "%s: reply cancelled for stop", merged)
-          raise RuntimeError("server stopped")
-        elif reply["error"]:
-          debug(self._ID, 2, "%s: reply was an error", merged)
-          raise reply["error"]
-        elif not reply["pending"]:
-          debug(self._ID, 2, "%s: reply complete", merged)
-          break
+      with self._cv:
+        newval = None
+        now = time.time()
+        if not self._has(merged):
+          # unlikely but possible it got removed
+          debug(self._ID, 2, "%s: replacing lost key", merged)
+          self._put(merged, 0, None)
+        group, val = self._get(merged)
+        status["state"] = (degraded and "stale") or "fresh"
+        status["age"] = age
+        self._count(status["state"], merged)
+        if val.expires >= now:
+          debug(self._ID, 1, "%s: returning valid value", merged)
+          self._touch(merged)
+          return val.data
+
+        # If some inputs are last good values, only keep the result
+        # until they can be refetched. If none of the inputs changed
+        # since the last merge, just extend the merged value.
+        until = min(now + expires, degraded or 1e100)
+        digests = {}
+        for title in urls:
+          meta = title in group and group[title].meta
+          digests[title] = (meta or {}).get("digest")
+        if val.data is not None and val.meta \
+           and val.meta.get("inputs") == digests \
+           and None not in digests.itervalues():
+          debug(self._ID, 2, "%s: inputs unchanged, keeping value", merged)
+          self._count("merge-skipped", merged)
+          self._put(merged, until, val.data, val.size, val.meta)
+          return val.data
         else:
-          debug(self._ID, 3, "%s: waiting for reply", merged)
-          signal.wait()
-
-    with self._cv:
-      newval = None
-      now = time.time()
-      if not self._has(merged):
-        # unlikely but possible it got removed
-        debug(self._ID, 2, "%s: replacing lost key", merged)
-        self._put(merged, 0, None)
-      group, val = self._get(merged)
-      if val.expires >= now:
-        debug(self._ID, 1, "%s: returning valid value", merged)
-        return val.data
-      else:
-        debug(self._ID, 2, "%s: merging new value", merged)
-        newval = merge(group)
-        self._put(merged, now + expires, newval)
-        return newval
-
-  def _purge(self, now, container, key, val):
-    if isinstance(val, dict):
-      for k, v in val.items():
-        self._purge(now, val, k, v)
-      if container and not val:
-        del container[key]
-    elif val.expires and val.expires < now:
-      del container[key]
+          debug(self._ID, 2, "%s: merging new value", merged)
+          self._count("merged", merged)
+          newval = merge(group)
+          self._put(merged, until, newval, None, { "inputs": digests })
+          return newval
+    finally:
+      with self._cv:
+        self._pinned[section] -= 1
+        if not self._pinned[section]:
+          del self._pinned[section]
+        self._evict()
+
+  def _put(self, key, expires, value, size=None, meta=None):
+    container, val = ContentCache._put(self, key, expires, value, size, meta)
+    if expires:
+      # Keep merged values one more period past expiry so fetch() can
+      # reuse them if the refetched inputs turn out to be unchanged.
+      purge = expires
+      if key[-1] == "merged" and value is not None:
+        purge += max(0, expires - time.time())
+      heapq.heappush(self._expiry, (purge, expires, key))
+    if value is not None:
+      self._touch(key)
+      self._evict()
+    return container, val
+
+  def _touch(self, key):
+    """Mark `key` as the most recently used value."""
+    self._lru.pop(key, None)
+    self._lru[key] = True
+
+  def _evict(self):
+    """Evict least recently used values until the cache is within its
+    byte budget. Values being fetched or waiting to be merged are never
+    evicted."""
+    if not self._maxbytes or self._nbytes <= self._maxbytes:
+      return
+
+    victims = []
+    excess = self._nbytes - self._maxbytes
+    for key in self._lru:
+      if excess <= 0:
+        break
+      if key in self._inflight or key[:-1] in self._pinned:
+        continue
+      try:
+        container, val = self._get(key)
+      except KeyError:
+        continue
+      if not val.size:
+        continue
+      victims.append((container, key, val))
+      excess -= val.size
+
+    for container, key, val in victims:
+      debug(self._ID, 2, "%s: evicting %d bytes", key, val.size)
+      self._count("evicted", key[0])
+      self._delete(container, key, val)
+
+  def _delete(self, container, key, val):
+    """Remove value `val` of `key` from its section `container`. The
+    statistics of the key, and of the section once it is empty, go
+    with it so they do not pile up for keys which are never reused."""
+    self._account(key, val, None)
+    self._lru.pop(key, None)
+    self._uncount(key)
+    del self._values[key]
+    sect, name = self._split(key)
+    del container[name]
+    if not container:
+      del self._sections[sect]
+      self._uncount(sect)
+
+  def _purge(self, now):
+    """Remove values which expired before `now`, plus the time expired
+    values are retained for. Uses the expiry index, ordered by the time
+    each value may be purged, so only the entries actually due are
+    visited. Index entries for values which have been replaced since are
+    simply dropped. Values whose refresh has failed are kept as the last
+    good value until the refresh succeeds."""
+    kept = []
+    while self._expiry and self._expiry[0][0] + self._retain < now:
+      item = heapq.heappop(self._expiry)
+      _, expires, key = item
+      try:
+        container, val = self._get(key)
+      except KeyError:
+        continue
+      if val.expires != expires:
+        continue
+      if key in self._failures and val.data is not None:
+        kept.append(item)
+        continue
+      self._delete(container, key, val)
+
+    for item in kept:
+      heapq.heappush(self._expiry, item)
 
   def run(self):
     with self._cv:
+      self._warmup()
       while not self._stopme:
         debug(self._ID, 1, "processing requests")
         self._reqman.process(lock = self._cv.acquire, unlock = self._cv.release)
 
         debug(self._ID, 1, "purging values")
-        self._purge(time.time(), None, None, self._values)
+        self._purge(time.time())
 
         debug(self._ID, 1, "waiting")
         if not self._stopme:
@@ -310,23 +905,58 @@ class ContentProxy(ContentCache):
         debug(self._ID, 1, "wait done")
 
     debug(self._ID, 1, "server thread stopped, waking waiters")
-    for s in self._signals:
-      with s:
-        s.notifyAll()
+    with self._cv:
+      waiters = sum(self._inflight.values(), [])
+    for result in waiters:
+      with result["signal"]:
+        result["signal"].notifyAll()
     debug(self._ID, 1, "server thread stopped")
 
 class ContentScraper(ContentCache):
   """Utility to get content from the web"""
   _ID = "CSCRAPER"
-
-  def __init__(self, appconfig):
+  _SNAPSHOT_INTERVAL = 600
+  _SNAPSHOT_SPREAD = 900
+  _ADAPT_FACTOR = 2
+
+  def __init__(self, appconfig, statedir=None, idle=0, idleperiod=None):
+    """Create a new scraper. If `statedir` is given, values are saved
+    to and restored from a snapshot file in it.
+
+    If `idle` is non-zero, scrape sections whose data has not been
+    accessed via `touch()` in that many seconds are fetched only once
+    every `idleperiod` seconds, or not at all if `idleperiod` is None,
+    until accessed again.
+
+    If the ``scrapemaxperiod`` setting is longer than the period of a
+    registration, items whose content does not change are fetched less
+    often, up to that period, and at the registered period again once
+    their content changes."""
     debug(self._ID, 1, "creating new content scraper")
     ContentCache.__init__(self, appconfig)
     self._scrape = []
+    self._due = []
+    self._seq = itertools.count()
+    self._idle = idle
+    self._idleperiod = idleperiod
+    self._accessed = {}
+    self._parked = {}
+    self._resources = {}
+    self._aliases = {}
+    self._sectionalias = {}
+    self._duplicates = 0
+    self._scrapeitems = {}
+    self._same = set()
+    self._changed = set()
+    self._maxperiod = getattr(appconfig, "scrapemaxperiod", 0)
+    self._snapshot = statedir and "%s/%s.snapshot" % (statedir, self._ID.lower())
+    self._last_snapshot = time.time()
+    if self._snapshot:
+      self._load()
 
   def scrape(self, section, urls,
              content_type="application/json",
-             period=900, convert=None):
+             period=900, convert=None, maxbytes=None):
     """
     Register URLs for scraping content. Usually the content is JSON but it can
     be something else too, like HTML. All the URLs will be fetched, converted
@@ -337,52 +967,338 @@ class ContentScraper(ContentCache):
     :arg str content_type: expected content type in response
     :arg callable convert: response conversion, e.g. cjson.decode
     :arg dict urls: (title, url) or (title, (url, urledit)) of data to retrieve
+    :arg int maxbytes: maximum response size, if not the server default
+
+    A URL already registered with the same URL editor, content type and
+    conversion is not fetched again. Its values are copied to the keys
+    of all registrations instead, and it is fetched at the shortest of
+    their periods.
     """
     debug(self._ID, 1, "%s: scrape %s, period %d, content type %s",
           section, urls, period, content_type)
     with self._cv:
       if isinstance(section, basestring): section = (section,)
-      map(lambda title: self._put(section + (title,), 0, None), urls.keys())
-      self._scrape.append({ "section": section, "period": period,
-                            "content_type": content_type, "urls": urls,
-                            "convert": convert })
+      s = { "section": section, "period": period,
+            "content_type": content_type, "urls": urls,
+            "convert": convert, "maxbytes": maxbytes,
+            "phases": {}, "current": {}, "base": {}, "interval": {} }
+      self._scrape.append(s)
+      self._accessed.setdefault(section, time.time())
+
+      # Give each item a random phase within its period so fetches are
+      # spread out evenly, and schedule it to be fetched as soon as the
+      # value we have, if any, expires.
+      now = time.time()
+      for title, url in urls.iteritems():
+        key = section + (title,)
+        if not self._has(key):
+          self._put(key, 0, None)
+
+        if not isinstance(url, tuple):
+          url = (url, None)
+        resource = url + (content_type, convert)
+        if resource in self._resources:
+          self._duplicate(self._resources[resource], s, title)
+          continue
+
+        self._resources[resource] = self._scrapeitems[key] = (s, title)
+        s["base"][title] = s["interval"][title] = period
+        s["phases"][title] = random.uniform(0, period)
+        _, val = self._get(key)
+        self._schedule(max(val.expires, now), s, title)
       self._cv.notifyAll()
 
+  def _duplicate(self, primary, s, title):
+    """Make item `title` of scrape `s` an alias of the already registered
+    item `primary`, a (scrape, title) tuple, for the same resource."""
+    ps, ptitle = primary
+    pkey = ps["section"] + (ptitle,)
+    key = s["section"] + (title,)
+    debug(self._ID, 2, "%s: same resource as %s", key, pkey)
+    self._duplicates += 1
+    self._count("duplicates", s["section"])
+    self._scrapeitems[key] = primary
+    ps["base"][ptitle] = min(ps["base"][ptitle], s["period"])
+    ps["interval"][ptitle] = min(ps["interval"][ptitle], s["period"])
+    if key != pkey:
+      self._alias(pkey, key)
+      if s["section"] != ps["section"]:
+        self._sectionalias.setdefault(s["section"], set()).add(ps["section"])
+
+  def _alias(self, pkey, key):
+    """Store values for `pkey` under `key` too."""
+    aliases = self._aliases.setdefault(pkey, [])
+    if key not in aliases:
+      aliases.append(key)
+      if self._has(pkey, lambda v: v.data is not None):
+        _, val = self._get(pkey)
+        self._put(key, val.expires, val.data, val.size, val.meta)
+
+  def _store(self, task, value, size=None, meta=None):
+    with self._cv:
+      ContentCache._store(self, task, value, size, meta)
+      for key in self._aliases.get(task.key, ()):
+        self._put(key, time.time() + task.period, value, size, meta)
+
+  def statistics(self):
+    """Return cache statistics, including the current refresh period of
+    items fetched at other than their base period."""
+    stats = ContentCache.statistics(self)
+    with self._cv:
+      for key, (s, title) in self._scrapeitems.iteritems():
+        if s["interval"][title] != s["base"][title]:
+          stats[("period", "/".join(key))] = s["interval"][title]
+    return stats
+
+  def period(self, key):
+    """Return the current refresh period in seconds of scraped `key`."""
+    with self._cv:
+      s, title = self._scrapeitems[key]
+      return s["interval"][title]
+
+  def _unchanged(self, task, value):
+    self._same.add(task.key)
+
+  def _adapt(self, s, title, changed):
+    """Adjust the refresh period of item `title` of scrape `s` after a
+    fetch found its content `changed` or not. Unchanged content backs
+    off the period up to the maximum, changed content resets it to the
+    base period, the shortest period the item was registered with.
+    Returns True if the period changed."""
+    interval = s["interval"][title]
+    if changed:
+      s["interval"][title] = s["base"][title]
+    elif self._maxperiod > s["base"][title]:
+      s["interval"][title] = min(self._maxperiod, interval * self._ADAPT_FACTOR)
+    if s["interval"][title] == interval:
+      return False
+
+    debug(self._ID, 2, "%s: %s, refresh period now %d", s["section"] + (title,),
+          (changed and "changed") or "unchanged", s["interval"][title])
+    self._count((changed and "period-reset") or "period-longer", s["section"])
+    return True
+
+  def touch(self, section):
+    """Record that a client accessed the data of scrape `section`. If
+    the section had gone idle, its items are refetched right away and
+    then resume their normal period."""
+    if not self._idle:
+      return
+
+    # Recording the access needs no lock, only resuming a parked section.
+    now = time.time()
+    sections = [section] + list(self._sectionalias.get(section, ()))
+    for section in sections:
+      self._accessed[section] = now
+    if not [section for section in sections if section in self._parked]:
+      return
+
+    with self._cv:
+      for section in sections:
+        parked = self._parked.pop(section, None)
+        if parked:
+          debug(self._ID, 1, "%s: resuming idle section", section)
+          self._count("resumed", section)
+          for s, title in parked.itervalues():
+            self._schedule(now, s, title)
+          self._cv.notifyAll()
+
+  def _schedule(self, due, s, title):
+    """Schedule item `title` of scrape `s` to be fetched at `due`. Any
+    earlier schedule for the item is cancelled."""
+    seq = s["current"][title] = self._seq.next()
+    heapq.heappush(self._due, (due, seq, s, title))
+
+  def _park(self, now, s, title):
+    """Slow down or suspend item `title` of idle scrape `s`."""
+    debug(self._ID, 2, "%s: section idle, %s %s", s["section"],
+          (self._idleperiod and "slowing down") or "suspending", title)
+    self._count("idle", s["section"])
+    self._parked.setdefault(s["section"], {})[(id(s), title)] = (s, title)
+    if self._idleperiod:
+      self._schedule(now + self._idleperiod, s, title)
+
+  def _nextdue(self, now, period, phase):
+    """Return the first time at least half a `period` after `now` which
+    falls on `phase` within the period. Once an item is on its phase
+    this returns exactly one period later."""
+    due = now + period / 2.
+    return due + (phase - due) % period
+
+  def _load(self):
+    """Load values saved in the snapshot file, if any. Values which have
+    already expired are kept, but given a new random expiry time in the
+    near future so they are refetched gradually rather than all at once."""
+    if not os.path.exists(self._snapshot):
+      return
+
+    try:
+      items = cPickle.load(open(self._snapshot, "rb"))
+      if not isinstance(items, list):
+        raise TypeError("expected list, got %s" % type(items).__name__)
+    except Exception, e:
+      cherrypy.log("SCRAPER ERROR failed to load snapshot %s: %s"
+                   % (self._snapshot, str(e)))
+      return
+
+    # Skip entries we do not understand, e.g. from an older format.
+    now = time.time()
+    nloaded = 0
+    with self._cv:
+      for item in items:
+        try:
+          key, expires, data, size, meta = item
+          if expires < now:
+            expires = now + random.uniform(0, self._SNAPSHOT_SPREAD)
+          self._put(key, expires, data, size, meta)
+          nloaded += 1
+        except Exception, e:
+          cherrypy.log("SCRAPER WARNING skipping bad entry in snapshot %s: %s"
+                       % (self._snapshot, str(e)))
+    debug(self._ID, 1, "loaded %d of %d values from snapshot %s",
+          nloaded, len(items), self._snapshot)
+
+  def _save(self):
+    """Save current values to the snapshot file. Must be called with the
+    lock held; the values are collected under the lock, but written out
+    without it. The file is replaced atomically so a crash never leaves
+    a partial snapshot behind."""
+    self._last_snapshot = time.time()
+    items = [(key, val.expires, val.data, val.size, val.meta)
+             for key, val in self._values.iteritems()
+             if val.data is not None]
+    try:
+      self._cv.release()
+      dirname = self._snapshot.rsplit("/", 1)[0]
+      (fd, tmp) = mkstemp(dir=dirname)
+      try:
+        with os.fdopen(fd, "wb") as f:
+          cPickle.dump(items, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self._snapshot)
+      except:
+        os.unlink(tmp)
+        raise
+      debug(self._ID, 1, "saved %d values to snapshot %s",
+            len(items), self._snapshot)
+    except Exception, e:
+      cherrypy.log("SCRAPER ERROR failed to save snapshot %s: %s"
+                   % (self._snapshot, str(e)))
+    finally:
+      self._cv.acquire()
+
   def run(self):
     with self._cv:
+      if self._duplicates:
+        cherrypy.log("SCRAPER INFO %s collapsed %d duplicate scrape registrations"
+                     % (self._ID, self._duplicates))
+      self._warmup()
       while not self._stopme:
         debug(self._ID, 1, "executing scrape cycle")
         now = time.time()
-        for s in self._scrape:
-          for title, url in s["urls"].iteritems():
-            key = s["section"] + (title,)
-            debug(self._ID, 3, "%s: considering %s", key, url)
-            _, val = self._get(key)
-            if val.expires < now:
-              if isinstance(url, tuple):
-                url, urledit = url
-                if urledit:
-                  url = urledit(url)
-              debug(self._ID, 2, "%s: refetching expired %s (%.2f ago)",
-                    key, url, now - val.expires)
-              self._reqman.put(Task(url, key, s["period"], s["content_type"],
-                                    s["convert"], None))
+        fetched = []
+        while self._due and self._due[0][0] <= now:
+          due, seq, s, title = heapq.heappop(self._due)
+          if s["current"][title] != seq:
+            continue
+          key = s["section"] + (title,)
+          url = s["urls"][title]
+          urledit = None
+          if isinstance(url, tuple):
+            url, urledit = url
+          blocked = self._blocked(key, url, now)
+          if blocked:
+            debug(self._ID, 2, "%s: backing off %s for %.2f seconds",
+                  key, url, blocked - now)
+            self._schedule(blocked, s, title)
+            continue
+          if urledit:
+            url = urledit(url)
+          debug(self._ID, 2, "%s: refetching %s (due %.2f ago)",
+                key, url, now - due)
+          self._reqman.put(Task(url, key, s["interval"][title], s["content_type"],
+                                s["convert"], None, s["maxbytes"]))
+          fetched.append((s, title))
 
         debug(self._ID, 1, "processing requests")
         self._reqman.process(lock = self._cv.acquire, unlock = self._cv.release)
 
-        debug(self._ID, 1, "waiting")
-        if not self._stopme:
-          self._cv.wait(30)
+        # Reschedule what we fetched: retry after backing off if the fetch
+        # failed, otherwise on its phase, including while the new value is
+        # still being converted. The value we had may well still be valid
+        # after a failure, so go by the recorded failure, not the expiry.
+        # Sections nobody has looked at for a while are put to rest.
+        now = time.time()
+        for s, title in fetched:
+          key = s["section"] + (title,)
+          if key in self._failures and key not in self._converting:
+            self._schedule(self._retrytime(key, now), s, title)
+          elif self._idle and now - self._accessed[s["section"]] > self._idle:
+            self._park(now, s, title)
+          else:
+            # Adapt the period only once the fetch has succeeded; a new
+            # value still being converted after a failure doesn't count.
+            if key not in self._failures:
+              self._adapt(s, title, key in self._changed or key not in self._same)
+            self._schedule(self._nextdue(now, s["interval"][title], s["phases"][title]),
+                           s, title)
+        self._same.clear()
+        self._changed.clear()
+
+        if self._snapshot and now - self._last_snapshot > self._SNAPSHOT_INTERVAL:
+          self._save()
+
+        # Sleep until the next item is due, or it's time for a snapshot.
+        timeout = None
+        if self._due:
+          timeout = self._due[0][0]
+        if self._snapshot:
+          timeout = min(timeout or 1e100, self._last_snapshot + self._SNAPSHOT_INTERVAL)
+        if timeout is not None:
+          timeout = max(0, timeout - time.time())
+
+        debug(self._ID, 1, "waiting %s", timeout)
+        if not self._stopme and timeout != 0:
+          self._cv.wait(timeout)
         debug(self._ID, 1, "wait done")
 
+      if self._snapshot:
+        self._save()
+
     debug(self._ID, 1, "server thread stopped")
 
+class ImageScan:
+  """Conversion of a scraped HTML page into the images found on it.
+  Scans for the same images on behalf of the same scraper compare
+  equal, so identical page registrations can be recognised."""
+  def __init__(self, scraper, match, images):
+    self.scraper = scraper
+    self.match = match
+    self.images = tuple(images or ())
+
+  def _id(self):
+    return (id(self.scraper), self.match.pattern, self.match.flags, self.images)
+
+  def __call__(self, task, c, page):
+    return self.scraper._images(task, page, self.match, self.images)
+
+  def __eq__(self, other):
+    return isinstance(other, ImageScan) and self._id() == other._id()
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self._id())
+
 class ImageScraper(ContentScraper):
   """Utility to get images from the web"""
   _ID = "ISCRAPER"
-  _rximg = re.compile(r"<img\s+(.*?)/?>", re.I)
-  _rxattr = re.compile(r"^([-A-Za-z0-9]+)=(\"[^\"]*\"|'[^']*'|\S+)\s*/?")
+  _rximg = re.compile(r"<[iI][mM][gG]\s+([^>]*)>")
+  _rxattr = re.compile(r"([-A-Za-z0-9]+)=(\"[^\"]*\"|'[^']*'|\S+)\s*/?")
+
+  def __init__(self, appconfig, statedir=None, idle=0, idleperiod=None):
+    ContentScraper.__init__(self, appconfig, statedir, idle, idleperiod)
+    self._imagepage = {}
 
   def scrape(self, section, url, images=None, match=None, period=900, urledit=None):
     """
@@ -402,47 +1318,119 @@ class ImageScraper(ContentScraper):
     debug(self._ID, 1, "%s: scrape %s, images %s match %s period %d",
           section, url, images, match, period)
     if match:
+      match = re.compile(match)
       ContentScraper.scrape(self, section, { "page": (url, urledit) },
                             period = period, content_type = "text/html",
-                            convert = lambda t,c,v: \
-                              self._images(t, v, match, images))
+                            convert = ImageScan(self, match, images))
     else:
       ContentScraper.scrape(self, section[:-1], { section[-1]: (url, urledit) },
                             period = period, content_type = "image/*",
                             convert = self._pngdata)
 
+  def _duplicate(self, primary, s, title):
+    """Alias the images of a duplicate page as well as the page."""
+    ContentScraper._duplicate(self, primary, s, title)
+    ps, ptitle = primary
+    if isinstance(s["convert"], ImageScan) and s["section"] != ps["section"]:
+      for name in s["convert"].images:
+        key = s["section"] + (name,)
+        if not self._has(key):
+          self._put(key, 0, None)
+        self._alias(ps["section"] + (name,), key)
+
   def _images(self, task, page, match, images):
+    """Scan `page` for images matching compiled pattern `match` and
+    request them. Returns the list of (key, url) of the images found,
+    which is stored as the value of the page so the images can be
+    refetched even if the page itself is unchanged, or "x" if there
+    were none.
+
+    The page is scanned in one pass: attributes are matched in place
+    within each tag by offset, without copying the page or the tags.
+    The tag pattern avoids case-insensitive and non-greedy matching as
+    both are slow; a "/" closing the tag is dropped by hand instead."""
     debug(self._ID, 2, "%s: scanning images in %s", task.key, task.url)
+    found = []
     img = 0
-    for imgtag in re.findall(self._rximg, page.replace("\n", " ")):
-      while True:
-        m = self._rxattr.match(imgtag)
-        if not m:
-          break
+    rxattr = self._rxattr.match
+    for t in self._rximg.finditer(page):
+      pos, end = t.span(1)
+      if end > pos and page[end-1] == "/":
+        end -= 1
+
+      m = rxattr(page, pos, end)
+      while m:
+        name, arg = m.groups()
+        m = rxattr(page, m.end(), end)
+        if name != "src":
+          continue
 
-        arg = m.group(2)
         if len(arg) >= 2 and arg[0] == '"' and arg[-1] == '"':
           arg = arg[1:-1]
         elif len(arg) >= 2 and arg[0] == "'" and arg[-1] == "'":
           arg = arg[1:-1]
+        if "\n" in arg:
+          arg = arg.replace("\n", " ")
 
-        if m.group(1) == "src" and re.search(match, arg):
+        if match.search(arg):
           arg = arg.replace("&amp;", "&").replace(" ", "%20")
           url = urlparse.urljoin(task.url, arg)
           key = task.key[:-1] + (images[img],)
-          debug(self._ID, 2, "%s: retrieving image #%d %s from %s (%s)",
+          debug(self._ID, 2, "%s: found image #%d %s at %s (%s)",
                 key, img+1, images[img], url, arg)
-          self._reqman.put(Task(url, key, task.period, "image/*",
-                                self._pngdata, None))
+          found.append((key, url))
           img += 1
-        imgtag = imgtag[m.end():]
 
     if img != len(images):
       cherrypy.log("SCRAPER WARNING %s found %d of %d images" %
                    (task.url, img, len(images)))
 
-    return "x"
+    with self._cv:
+      for key, url in found:
+        self._imagepage[key] = task.key
+      self._fetchimages(task, found)
+    return found or "x"
+
+  def _fetchimages(self, task, found):
+    """Request images `found` on the page of `task`, except those which
+    are backing off after failures. Must be called with the lock held."""
+    now = time.time()
+    for key, url in found:
+      if self._blocked(key, url, now):
+        debug(self._ID, 2, "%s: backing off image %s", key, url)
+        continue
+      debug(self._ID, 2, "%s: retrieving image from %s", key, url)
+      self._reqman.put(Task(url, key, task.period, "image/*",
+                            self._pngdata, None, task.maxbytes))
+
+  def period(self, key):
+    """Return the current refresh period in seconds of scraped `key`.
+    Images found on a page are refreshed along with the page."""
+    with self._cv:
+      return ContentScraper.period(self, self._imagepage.get(key, key))
+
+  def _unchanged(self, task, value):
+    """Refetch the images of an unchanged page: they may have changed
+    even if the page referring to them did not."""
+    ContentScraper._unchanged(self, task, value)
+    if isinstance(value, list):
+      self._fetchimages(task, value)
+
+  def _modified(self, task):
+    """Count a changed image as a change of the page it is on, so the
+    page goes back to its normal refresh period."""
+    with self._cv:
+      page = self._imagepage.get(task.key, None)
+      if page not in self._scrapeitems:
+        return
+      self._changed.add(page)
+      s, title = self._scrapeitems[page]
+      if self._adapt(s, title, True):
+        now = time.time()
+        self._schedule(self._nextdue(now, s["base"][title], s["phases"][title]),
+                       s, title)
 
+  @heavy
   def _pngdata(self, task, c, imgdata):
     """Return image `data` as PNG image, using MIME type `format`.
     Returns `data` as is if `format` is image/png, otherwise converts
@@ -473,7 +1461,7 @@ class ImageScraperEntity(RESTEntity):
       if not RX_PATH.match(name):
         raise InvalidParameter("Invalid path")
     item = self._prefix + tuple(param.args)
-    if not self.api.scraper.exists(item, lambda v: bool(v.data)):
+    if not self.api.scraper.exists(item, lambda v: isinstance(v.data, str) and v.data):
       raise MissingObject("No such image")
     safe.kwargs["item"] = item
     param.args[:] = []
@@ -481,7 +1469,20 @@ class ImageScraperEntity(RESTEntity):
   @restcall
   @tools.expires(secs=900)
   def get(self, item):
-    return self.api.scraper.data(item)
+    self.api.scraper.touch(item[:-1])
+    val = self.api.scraper.value(item)
+    meta = val.meta or {}
+    etag = '"%s"' % (meta.get("hash") or hashlib.sha1(val.data).hexdigest())
+    cherrypy.response.headers["ETag"] = etag
+    if "stored" in meta:
+      cherrypy.response.headers["Last-Modified"] = \
+        formatdate(meta["stored"], usegmt=True)
+
+    match = [t.strip() for t in
+             cherrypy.request.headers.get("If-None-Match", "").split(",")]
+    if etag in match or "*" in match:
+      raise cherrypy.HTTPRedirect([], 304)
+    return val.data
 
   def _lemon(self, section, images, prov, kind, match, **kwargs):
     base = (self.app.appconfig.lemon % (prov, kind)) + "?"